@@ -0,0 +1,6 @@
+"""Benchmarks for lofarstation, run from the repository root, e.g.
+
+    python -m benchmarks.stages --json results.json
+    python -m benchmarks.ms_storage
+
+They use synthetic inputs (see benchmarks.synthetic) so they need no observation data."""
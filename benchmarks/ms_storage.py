@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+"""Compare the MAIN table storage layout profiles: time to write a synthetic XST
+capture to a Measurement Set, and to read DATA back in time order (one integration
+at a time) and per baseline (every integration of a few baselines)."""
+
+from __future__ import print_function
+from __future__ import division
+from lofarstation.stationdata import XSTData
+from lofarstation.meas_set import storage_layouts
+from casacore.tables import table
+from . import synthetic
+import numpy as np
+import argparse
+import shutil
+import tempfile
+import time
+import os
+
+
+def read_time_order(ms_name, n_baseline):
+    t = table(ms_name, ack=False)
+    for startrow in range(0, t.nrows(), n_baseline):
+        t.getcol("DATA", startrow, n_baseline)
+    t.close()
+
+
+def read_baselines(ms_name, n_baseline, baselines):
+    t = table(ms_name, ack=False)
+    n_block = t.nrows() // n_baseline
+    for bl in baselines:
+        t.getcol("DATA", bl, n_block, n_baseline)
+    t.close()
+
+
+def ms_size(ms_name):
+    return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(ms_name) for f in files)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--blocks", type=int, default=120, help="Integrations in the synthetic capture (default: 120)")
+    parser.add_argument("-b", "--baselines", type=int, default=16, help="Baselines read in the per baseline test (default: 16)")
+    parser.add_argument("-l", "--layouts", nargs="+", default=sorted(storage_layouts), choices=sorted(storage_layouts),
+                        help="Storage layouts to compare (default: all)")
+    parser.add_argument("-d", "--dir", type=str, default=None, help="Directory for the test files (default: a temporary directory)")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(dir=args.dir)
+    try:
+        xst = synthetic.write_xst(directory, args.blocks)
+        print("{:12s} {:>8s} {:>12s} {:>16s} {:>8s}".format("layout", "write s", "read time s", "read baseline s", "size MB"))
+        for layout in args.layouts:
+            sd = XSTData(xst, 3, 300, 1.0, station_name="SE607")
+            ms_name = os.path.join(directory, layout + ".ms")
+            t0 = time.time()
+            sd.write_ms(ms_name, layout=layout)
+            t1 = time.time()
+            read_time_order(ms_name, sd.n_baseline)
+            t2 = time.time()
+            read_baselines(ms_name, sd.n_baseline, np.linspace(0, sd.n_baseline - 1, args.baselines).astype(int))
+            t3 = time.time()
+            print("{:12s} {:8.2f} {:12.3f} {:16.3f} {:8.1f}".format(layout, t1 - t0, t2 - t1, t3 - t2, ms_size(ms_name) / 1e6))
+            shutil.rmtree(ms_name)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
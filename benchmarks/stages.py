@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+"""Time each stage of turning station data into a Measurement Set on synthetic inputs:
+AntennaField and CalTable parsing, then for XST, ACC and TBBXC inputs loading, UVW
+calculation, calibration, packing to MS order and write_ms. Each stage records its
+wall time, the peak memory traced while it ran (numpy allocations, not memory maps)
+and the process peak RSS so far. Results are printed and can be written as JSON to
+compare runs across releases on the same hardware."""
+
+from __future__ import print_function
+from __future__ import division
+from lofarstation.stationdata import XSTData, ACCData, TBBXCData
+from lofarstation.stationcal import stationcal
+from lofarstation import antfield
+from lofarstation.instrumentation import max_rss_mb
+from . import synthetic
+import numpy as np
+import argparse
+import datetime
+import gc
+import json
+import platform
+import shutil
+import tempfile
+import time
+import os
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None # Python 2, only peak RSS is recorded
+
+STATION_NAME = "SE607"
+RCU_MODE = 3
+
+
+def measure(func):
+    """Run func, returning its result, wall time (s), traced peak memory (MB) and peak RSS (MB)"""
+    gc.collect()
+    if tracemalloc is not None:
+        tracemalloc.start()
+    t0 = time.time()
+    result = func()
+    seconds = time.time() - t0
+    peak = None
+    if tracemalloc is not None:
+        peak = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+    return result, seconds, peak, max_rss_mb()
+
+
+class Stages(object):
+    """Collects stage measurements, keeping the fastest time and largest peak over repeats"""
+    def __init__(self):
+        self.results = []
+        self._index = {}
+
+    def run(self, input_name, stage, func):
+        result, seconds, peak, rss = measure(func)
+        key = (input_name, stage)
+        if key in self._index:
+            entry = self._index[key]
+            entry["seconds"] = min(entry["seconds"], seconds)
+            entry["repeats"] += 1
+            if peak is not None:
+                entry["peak_traced_mb"] = max(entry["peak_traced_mb"], peak)
+            entry["max_rss_mb"] = rss
+        else:
+            entry = {"input": input_name, "stage": stage, "seconds": seconds, "repeats": 1,
+                     "peak_traced_mb": peak, "max_rss_mb": rss}
+            self._index[key] = entry
+            self.results.append(entry)
+        return result
+
+
+def parse_stages(stages, calfile):
+    antfile = antfield.station_path(STATION_NAME)
+    stages.run("common", "antfield_parse", lambda: antfield.from_file(antfile))
+    antfield.cached(antfile)
+    stages.run("common", "antfield_cached", lambda: antfield.cached(antfile))
+    stages.run("common", "caltable_parse", lambda: stationcal(calfile, mmap=False))
+    stationcal.cached(calfile)
+    stages.run("common", "caltable_cached", lambda: stationcal.cached(calfile))
+
+
+def pipeline_stages(stages, input_name, load, calfile, ms_name, uvw_method, chunk_size):
+    sd = stages.run(input_name, "load", load)
+    sd.uvw_method = uvw_method
+    stages.run(input_name, "uvw0", lambda: sd.uvw0)
+    def calibrate():
+        sd.set_station_cal(calfile)
+        sd.calculate_data()
+    stages.run(input_name, "calibrate", calibrate)
+    stages.run(input_name, "pack", lambda: sd.packed_data())
+    shutil.rmtree(ms_name, ignore_errors=True)
+    stages.run(input_name, "write_ms", lambda: sd.write_ms(ms_name, chunk_size=chunk_size))
+    shutil.rmtree(ms_name, ignore_errors=True)
+
+
+def environment():
+    env = {"python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(),
+           "machine": platform.machine(), "node": platform.node(),
+           "time": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")}
+    try:
+        import pkg_resources
+        env["lofarstation"] = pkg_resources.get_distribution("lofarstationdata").version
+    except Exception:
+        env["lofarstation"] = "unknown"
+    return env
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-i", "--inputs", nargs="+", default=["xst", "acc", "tbbxc"], choices=["xst", "acc", "tbbxc"],
+                        help="Input types to benchmark (default: all)")
+    parser.add_argument("--xst-blocks", type=int, default=60, help="Integrations in the XST file (default: 60)")
+    parser.add_argument("--tbbxc-blocks", type=int, default=10, help="Integrations in the TBBXC file (default: 10)")
+    parser.add_argument("--tbbxc-channels", type=int, default=16, help="Channels in the TBBXC file (default: 16)")
+    parser.add_argument("--uvw", type=str, default="exact", choices=XSTData.uvw_methods, help="UVW method (default: exact)")
+    parser.add_argument("--chunksize", type=int, default=64, help="write_ms chunk size (default: 64)")
+    parser.add_argument("-n", "--repeat", type=int, default=1, help="Runs of each stage, the fastest is kept (default: 1)")
+    parser.add_argument("-d", "--dir", type=str, default=None, help="Directory for the test files (default: a temporary directory)")
+    parser.add_argument("--json", type=str, default=None, help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(dir=args.dir)
+    stages = Stages()
+    try:
+        calfile = synthetic.write_caltable(directory, STATION_NAME, RCU_MODE)
+        loaders = {}
+        if "xst" in args.inputs:
+            xst = synthetic.write_xst(directory, args.xst_blocks)
+            loaders["xst"] = lambda: XSTData(xst, RCU_MODE, 300, 1.0, station_name=STATION_NAME)
+        if "acc" in args.inputs:
+            acc = synthetic.write_acc(directory)
+            loaders["acc"] = lambda: ACCData(acc, RCU_MODE, station_name=STATION_NAME)
+        if "tbbxc" in args.inputs:
+            tbbxc = synthetic.write_tbbxc(directory, args.tbbxc_blocks, args.tbbxc_channels)
+            loaders["tbbxc"] = lambda: TBBXCData(tbbxc, RCU_MODE, 1.0, station_name=STATION_NAME,
+                                                 start_time=datetime.datetime(2017, 1, 1, 12))
+        for repeat in range(args.repeat):
+            parse_stages(stages, calfile)
+            for input_name in args.inputs:
+                pipeline_stages(stages, input_name, loaders[input_name], calfile,
+                                os.path.join(directory, input_name + ".ms"), args.uvw, args.chunksize)
+    finally:
+        shutil.rmtree(directory)
+
+    print("{:8s} {:16s} {:>10s} {:>12s} {:>12s}".format("input", "stage", "seconds", "traced MB", "max RSS MB"))
+    for r in stages.results:
+        print("{:8s} {:16s} {:10.4f} {:>12s} {:>12s}".format(r["input"], r["stage"], r["seconds"],
+              "-" if r["peak_traced_mb"] is None else "{:.1f}".format(r["peak_traced_mb"]),
+              "-" if r["max_rss_mb"] is None else "{:.1f}".format(r["max_rss_mb"])))
+    if args.json:
+        config = dict((k, v) for k, v in vars(args).items() if k not in ("json", "dir"))
+        with open(args.json, "w") as f:
+            json.dump({"environment": environment(), "config": config, "results": stages.results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
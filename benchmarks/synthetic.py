@@ -0,0 +1,66 @@
+"""Generators of synthetic station data files with random contents but the layout
+and names of the real ones: XST and ACC .dat files, TBB cross correlation .npy
+files and CalTables."""
+
+from __future__ import division
+from lofarstation.stationcal import DEFAULT_N_FREQ, DEFAULT_N_RCU
+import numpy as np
+import os
+
+START_TIME = "20170101_120000"
+
+
+def _random_matrix(rng, n_inputs, n_channel):
+    """Return random Hermitian complex128 correlation matrices, input * input * channel"""
+    m = rng.standard_normal((n_inputs, n_inputs, n_channel, 2)).view(np.complex128)[...,0]
+    return 0.5 * (m + m.conj().swapaxes(0, 1))
+
+
+def _random_blocks(f, rng, n_block, n_inputs, n_channel=1):
+    """Write n_block random correlation matrices to the open file f, one at a time"""
+    for i in range(n_block):
+        _random_matrix(rng, n_inputs, n_channel).tofile(f)
+
+
+def write_xst(directory, n_block, n_inputs=DEFAULT_N_RCU, seed=0):
+    """Write an XST file of n_block integrations and return its name"""
+    name = os.path.join(directory, "{}_xst.dat".format(START_TIME))
+    with open(name, "wb") as f:
+        _random_blocks(f, np.random.RandomState(seed), n_block, n_inputs)
+    return name
+
+
+def write_acc(directory, n_inputs=DEFAULT_N_RCU, n_subband=DEFAULT_N_FREQ, seed=0):
+    """Write an ACC file, one integration for each of n_subband subbands, and return its name"""
+    name = os.path.join(directory, "{}_acc_{}x{}x{}.dat".format(START_TIME, n_subband, n_inputs, n_inputs))
+    with open(name, "wb") as f:
+        _random_blocks(f, np.random.RandomState(seed), n_subband, n_inputs)
+    return name
+
+
+def write_tbbxc(directory, n_block, n_channel, n_inputs=DEFAULT_N_RCU, seed=0):
+    """Write a TBB cross correlation .npy file, block * input * input * channel, and return its name"""
+    name = os.path.join(directory, "{}_tbbxc.npy".format(START_TIME))
+    rng = np.random.RandomState(seed)
+    data = np.lib.format.open_memmap(name, mode="w+", dtype=np.complex128, shape=(n_block, n_inputs, n_inputs, n_channel))
+    for i in range(n_block):
+        data[i] = _random_matrix(rng, n_inputs, n_channel)
+    data.flush()
+    del data
+    return name
+
+
+def write_caltable(directory, station_name, rcu_mode=3, n_freq=DEFAULT_N_FREQ, n_rcu=DEFAULT_N_RCU, seed=0):
+    """Write a CalTable of unit amplitude, random phase gains and return its name"""
+    name = os.path.join(directory, "CalTable-{}-mode{}.dat".format(station_name, rcu_mode))
+    header = ["HeaderStart",
+              "CalTableHeader.Observation.Station = {}".format(station_name),
+              "CalTableHeader.Observation.Mode = {}".format(rcu_mode),
+              "CalTableHeader.Observation.Date = 201701011200",
+              "CalTableHeader.Calibration.Name = synthetic",
+              "HeaderStop"]
+    phase = np.random.RandomState(seed).uniform(-np.pi, np.pi, (n_freq, n_rcu))
+    with open(name, "wb") as f:
+        f.write(("\n".join(header) + "\n").encode("ascii"))
+        np.exp(1j * phase).astype(np.complex128).tofile(f)
+    return name
@@ -1,27 +1,27 @@
 #!/usr/bin/env python
 
 """Read Lofar AntennaField conf files.
-The "centos7" format files are not supported."""
+The "centos7" format files are not supported.
+
+Arrays are returned as numpy arrays (from_file returned nested lists before). Parsed
+fields are cached in process, keyed by file path and modification time, and the
+fields of the stations bundled in AntennaFields/ are additionally kept as .npz files
+in a per user cache directory so that station lookups do not need to parse any text.
+The .npz files hold only arrays and are loaded without unpickling."""
 
 from __future__ import print_function
 import sys
+import os
 import json
+import logging
 import re
+import tempfile
+import numpy as np
 
-def multi_dim(data, shape, typ=float):
-    """Reshape 'data' list into a multi dimensional list with the given shape
-    conv is a function that is run on each element. Eg. to convert string to float"""
-    ret = []
-    if len(shape) == 1:
-        # We are on the final axis so read and return the required elements
-        for i in range(shape[0]):
-            ret.append(typ(data[0]))
-            del data[0]
-    else:
-        for i in range(shape[0]):
-            ret.append(multi_dim(data, shape[1:], typ))
-    return ret
-
+ANTENNA_FIELD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "AntennaFields")
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+                         "lofarstation", "AntennaFields")
+DICT_FIELDS = ("NORMAL_VECTOR", "ROTATION_MATRIX") # Stored by band, other fields as lists
 
 shape_re = re.compile("\((?P<start>\d+),(?P<end>\d+)\)")
 def read_dim(s):
@@ -32,48 +32,164 @@ def read_dim(s):
     else:
         raise ValueError("Could not parse {}".format(s))
 
+def read_shape(s):
+    """Read a blitz shape, either "3 x 2" or "(0,2) x (0,1)" style"""
+    try:
+        return tuple(read_dim(d.strip()) for d in s.split('x'))
+    except ValueError:
+        return tuple(int(d.strip(' ')) for d in s.split('x'))
+
 def read_array(stream):
+    """Read the next array from stream as a numpy array"""
     str_data = stream.readline().rstrip('\n')
-    if str_data == "":
+    if '[' not in str_data:
         raise ValueError
+    lines = [str_data]
     while ']' not in str_data:
-        str_data = str_data + ' ' + stream.readline().rstrip('\n')
-    shape, str_data = str_data.split('[')
+        str_data = stream.readline().rstrip('\n')
+        lines.append(str_data)
+    shape, str_data = ' '.join(lines).split('[')
     str_data, empty = str_data.split(']')
-    assert empty == ''
-    str_data = [x for x in str_data.split(' ') if x != '']
-    try:
-        shape = [read_dim(s.strip()) for s in shape.split('x')]
-    except ValueError:
-        shape = [int(s.strip(' ')) for s in shape.split('x')]
-    arr = multi_dim(str_data, shape)
-    assert len(str_data) == 0
-    return arr
+    assert empty.strip() == ''
+    return np.array(str_data.split(), dtype=np.float64).reshape(read_shape(shape))
 
 def read_positions(stream):
     positions = [read_array(stream)] # reference position
+    pos = stream.tell()
     try:
         # dipole positions, not provided for HBA "ears" in core station
         positions.append(read_array(stream))
     except ValueError:
-        pass
+        stream.seek(pos)
     return positions
 
 def from_file(filename):
-    stream = open(filename)
+    """Parse an AntennaField conf file into a dict. Positions are stored by band as
+    [reference position, dipole offsets], NORMAL_VECTOR and ROTATION_MATRIX by band."""
     AntennaField = {"NORMAL_VECTOR": {}, "ROTATION_MATRIX": {}}
-    line = stream.readline()
-    while line != "":
-        while line == "\n" or line.startswith('#'):
-            line = stream.readline()
-        if "NORMAL_VECTOR" in line or "ROTATION_MATRIX" in line:
-            arr_name, band = line.split()
-            AntennaField[arr_name][band] = read_array(stream)
-        else:
-            band = line.rstrip('\n')
-            AntennaField[band] = read_positions(stream)
+    with open(filename) as stream:
         line = stream.readline()
+        while line != "":
+            if line.strip() == "" or line.startswith('#'):
+                pass
+            elif "NORMAL_VECTOR" in line or "ROTATION_MATRIX" in line:
+                arr_name, band = line.split()
+                AntennaField[arr_name][band] = read_array(stream)
+            else:
+                band = line.strip()
+                AntennaField[band] = read_positions(stream)
+            line = stream.readline()
     return AntennaField
 
+def _freeze(field):
+    """Make the arrays of a parsed field read only, cached fields are shared"""
+    for value in field.values():
+        arrays = value.values() if isinstance(value, dict) else value
+        for arr in arrays:
+            arr.flags.writeable = False
+    return field
+
+# path: (mtime, AntennaField), fields parsed or loaded from CACHE_DIR in this process
+_cache = {}
+
+def _cache_path(name):
+    return os.path.join(CACHE_DIR, name + ".npz")
+
+def _load_cache_file(name, mtime):
+    """Return the field of bundled file name from CACHE_DIR, or None if it is not there
+    or was made from a different version of the file"""
+    try:
+        with np.load(_cache_path(name), allow_pickle=False) as arrays:
+            if arrays["mtime"] != mtime:
+                return None
+            field = dict((key, {}) for key in DICT_FIELDS)
+            for key in arrays.files:
+                if key == "mtime":
+                    continue
+                field_name, sub = key.split("/")
+                if field_name in DICT_FIELDS:
+                    field[field_name][sub] = arrays[key]
+                else:
+                    field.setdefault(field_name, []).append((int(sub), arrays[key]))
+    except Exception:
+        return None
+    for field_name, value in field.items():
+        if field_name not in DICT_FIELDS:
+            field[field_name] = [arr for i, arr in sorted(value, key=lambda item: item[0])]
+    return field
+
+def _save_cache_file(name, mtime, field):
+    """Write field, parsed from bundled file name, to CACHE_DIR. A uniquely named
+    temporary file is renamed into place, so concurrent writers do not collide."""
+    arrays = {"mtime": np.float64(mtime)}
+    for key, value in field.items():
+        items = value.items() if key in DICT_FIELDS else enumerate(value)
+        for sub, arr in items:
+            arrays["{}/{}".format(key, sub)] = arr
+    try:
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR, 0o700)
+        fd, tmp_name = tempfile.mkstemp(suffix=".tmp", prefix=name + ".", dir=CACHE_DIR)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **arrays)
+            os.rename(tmp_name, _cache_path(name))
+        except Exception:
+            os.remove(tmp_name)
+            raise
+    except (IOError, OSError) as e:
+        logging.debug("Could not write AntennaField cache {}: {}".format(_cache_path(name), e))
+
+def _is_bundled(path):
+    return os.path.dirname(path) == ANTENNA_FIELD_DIR
+
+def cached(filename):
+    """Return the parsed AntennaField of filename, parsing it only if it has not been
+    seen before or has changed since. The returned arrays are read only and shared."""
+    path = os.path.abspath(filename)
+    mtime = os.path.getmtime(path)
+    entry = _cache.get(path)
+    if entry is not None and entry[0] == mtime:
+        return entry[1]
+    if _is_bundled(path):
+        name = os.path.basename(path)
+        field = _load_cache_file(name, mtime)
+        if field is None:
+            field = from_file(path)
+            _save_cache_file(name, mtime, field)
+    else:
+        field = from_file(path)
+    _cache[path] = (mtime, _freeze(field))
+    return field
+
+def build_cache():
+    """Parse all bundled AntennaField files and write them to CACHE_DIR"""
+    for name in sorted(os.listdir(ANTENNA_FIELD_DIR)):
+        if name.endswith("-AntennaField.conf"):
+            path = os.path.join(ANTENNA_FIELD_DIR, name)
+            _save_cache_file(name, os.path.getmtime(path), from_file(path))
+
+def station_path(station_name):
+    """Return the path of the AntennaField conf included with this package for station_name"""
+    path = os.path.join(ANTENNA_FIELD_DIR, "{}-AntennaField.conf".format(station_name))
+    if os.path.exists(path):
+        return path
+    else:
+        raise ValueError("No AntennaField conf found for station: {}".format(station_name))
+
+def from_station(station_name):
+    """Return the (cached) AntennaField included with this package for station_name"""
+    return cached(station_path(station_name))
+
+def _to_lists(value):
+    if isinstance(value, dict):
+        return dict((k, _to_lists(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [_to_lists(v) for v in value]
+    return value.tolist()
+
 if __name__ == "__main__":
-    print(json.dumps(from_file(sys.argv[1])))
+    if sys.argv[1] == "--build-cache":
+        build_cache()
+    else:
+        print(json.dumps(_to_lists(from_file(sys.argv[1]))))
@@ -3,14 +3,26 @@
 from __future__ import division
 from __future__ import absolute_import
 from casacore.measures import measures
-from .stationdata import RCUMode, XSTData, ACCData, AARTFAACData, TBBXCData
+from .stationdata import RCUMode, XCStationData, XSTData, ACCData, AARTFAACData, TBBXCData, DEFAULT_CHUNK_SIZE, write_concat_ms
+from .uvw import DEFAULT_KNOT_INTERVAL
+from .meas_set.storage_layouts import storage_layouts, SMALL_TILE_ROWS
+from .stationcal import stationcal
+from .follow import follow, MSSink, DEFAULT_IDLE_TIMEOUT
+from . import antfield
+from .instrumentation import recording
+from multiprocessing import Pool
 from datetime import datetime
+import traceback
+import json
+import glob
 import sys
 import re
 import os.path
 import logging
 import argparse
 
+INPUT_EXTENSIONS = (".dat", ".npy", ".vis", ".cal") # Of station data files, never an output name
+
 def create_parser():
     parser = argparse.ArgumentParser()
     required = parser.add_argument_group('required arguments')
@@ -28,11 +40,122 @@ def create_parser():
     exclusive.add_argument("-a", "--acc", help="File is an ACC capture", action="store_true")
     exclusive.add_argument("-z", "--aart", help="File is an AARTFAAC .cal or .vis file. In case of a raw correlator .vis file, please specify the subband number via the -s option. In case of a .cal file, this is extracted from the header. Please also specify the array name via -n [A6,A12]", action="store_true")
     exclusive.add_argument("-b", "--tbbxc", help="File is TBB XC", action="store_true")
+    parser.add_argument("--uvw", type=str, choices=XCStationData.uvw_methods, default="exact", help="UVW calculation: exact uses casacore for every integration, fast only at hourly reference epochs, interpolate every --knotinterval seconds (default: exact)")
+    parser.add_argument("--knotinterval", type=float, default=DEFAULT_KNOT_INTERVAL, help="Seconds between exact UVWs with --uvw interpolate (default: {:g})".format(DEFAULT_KNOT_INTERVAL))
+    parser.add_argument("--chunksize", type=int, default=DEFAULT_CHUNK_SIZE, help="Number of blocks to process at a time when writing the MS (default: {})".format(DEFAULT_CHUNK_SIZE))
+    parser.add_argument("--storage", type=str, choices=sorted(storage_layouts), default="default", help="Storage layout of the MAIN table: default uses casacore default tiling for DATA only, tiled stores DATA, FLAG, UVW, WEIGHT and SIGMA in tiles of one integration, tiled_small in tiles of {} rows, compact as tiled for DATA and UVW and stores constant columns only where they change (default: default)".format(SMALL_TILE_ROWS))
+    parser.add_argument("--hdf5", help="Write an HDF5 visibility cube (data, UVWs and metadata as plain arrays) instead of a Measurement Set, needs h5py. Not with --concat", action="store_true")
+    parser.add_argument("--follow", help="Convert an XST capture that is still being written: new blocks are appended to the Measurement Set as they appear, until none have been written for --idle seconds. Single input only", action="store_true")
+    parser.add_argument("--idle", type=float, default=DEFAULT_IDLE_TIMEOUT, help="Seconds without new blocks after which --follow stops (default: {:g})".format(DEFAULT_IDLE_TIMEOUT))
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of files to convert in parallel (default: 1)")
+    parser.add_argument("--concat", help="Write all input files to a single Measurement Set in time order. They must be from the same station, mode and subband", action="store_true")
+    parser.add_argument("-o", "--msname", type=str, help="Output Measurement Set name, only with a single input file or --concat. Default is the (first) input name with .ms, or .h5 with --hdf5")
+    parser.add_argument("--timings", type=str, default=None, metavar="JSON", help="Write the wall time, bytes processed, change in RSS and process peak RSS of each processing stage, per output, to this JSON file")
     parser.add_argument("-q", "--quiet", help="Only display warnings and errors", action="store_true")
-    parser.add_argument("indata", help="Input data file name", type=str)
-    parser.add_argument("msname", help="Output Measurement Set name", type=str, nargs="?")
+    parser.add_argument("indata", help="Input data file names or glob patterns. For compatibility, a single input file may be followed by the output Measurement Set name, if that does not end in {}".format(", ".join(INPUT_EXTENSIONS)), type=str, nargs="+")
     return parser
 
+def default_msname(indata, extension=".ms"):
+    if indata.endswith(".dat"):
+        basename = indata[:-len(".dat")]
+    else:
+        basename = indata
+    return basename + extension
+
+def old_style_msname(patterns):
+    """Return the output name of the old style invocation "indata msname", or None. The
+    second argument is the MS name unless it has the extension of an input file, whether
+    or not it exists, so an existing MS is not read as an input and a missing input is
+    not taken as the output name."""
+    if len(patterns) == 2 and not patterns[1].lower().endswith(INPUT_EXTENSIONS):
+        return patterns[1]
+    return None
+
+def expand_inputs(patterns):
+    """Expand glob patterns, keeping names that match nothing so they are reported as missing"""
+    indata = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        indata.extend(matches if matches else [pattern])
+    return indata
+
+# Static inputs shared by all conversions, set once per worker process
+_shared = {}
+
+def _init_worker(args, antenna_field, station_cal):
+    _shared["args"] = args
+    _shared["antenna_field"] = antenna_field
+    _shared["station_cal"] = station_cal
+
+def load(args, indata, antenna_field, station_cal, first_block=0, n_blocks=None):
+    """Load a single file. antenna_field and station_cal are parsed once and
+    shared between files, the raw file name arguments are used if they are empty.
+    first_block and n_blocks select part of an XST capture."""
+    if not os.path.exists(indata):
+        raise IOError("No such file: {}".format(indata))
+    acc = args.acc
+    if not args.xst and not args.acc and not args.aart and not args.tbbxc:
+        if re.match("^\d{8}_\d{6}_acc_512x192x192.dat$", os.path.basename(indata)):
+            logging.info("Assuming data is ACC based on filename")
+            acc = True
+        else:
+            logging.info("Data type not specified - assuming XST")
+    antfile = antenna_field if antenna_field else args.antfield
+
+    if acc:
+        station_data = ACCData(indata, args.rcumode, args.subband, antfile, args.starttime, args.direction, args.stationname)
+    elif args.aart:
+        station_data = AARTFAACData (indata, args.rcumode, args.subband,args.nchan, antfile, args.starttime, args.direction, args.stationname)
+    elif args.tbbxc:
+        station_data = TBBXCData(indata, args.rcumode, args.integration, antfile, args.starttime, args.direction, args.stationname)
+    else:
+        station_data = XSTData(indata, args.rcumode, args.subband, args.integration, antfile, args.starttime, args.direction, args.stationname,
+                               first_block=first_block, n_blocks=n_blocks)
+
+    station_data.uvw_method = args.uvw
+    station_data.uvw_knot_interval = args.knotinterval
+    if station_cal is not None:
+        station_data.set_station_cal(station_cal)
+    return station_data
+
+def convert(args, indata, msname, antenna_field, station_cal):
+    """Convert a single file to a Measurement Set, or an HDF5 file with --hdf5"""
+    station_data = load(args, indata, antenna_field, station_cal)
+    if args.hdf5:
+        station_data.write_hdf5(msname, args.chunksize)
+    else:
+        station_data.write_ms(msname, args.stationname, args.chunksize, args.storage)
+
+def follow_capture(args, indata, msname, antenna_field, station_cal):
+    """Convert an XST capture that is still being written, chunksize blocks at most at a time"""
+    load_blocks = lambda first_block, n_blocks: load(args, indata, antenna_field, station_cal, first_block, n_blocks)
+    sink = MSSink(msname, args.stationname, args.chunksize, args.storage)
+    return follow(indata, load_blocks, sink, max_blocks=args.chunksize, idle_timeout=args.idle)
+
+def concatenate(args, inputs, msname, antenna_field, station_cal):
+    """Convert all inputs to a single Measurement Set"""
+    write_concat_ms(inputs, msname, args.stationname, args.chunksize, args.storage,
+                    load=lambda indata: load(args, indata, antenna_field, station_cal))
+
+def _convert_job(job):
+    """Convert one (indata, msname) pair in a worker, returning an error message or ''
+    and the stage timings"""
+    indata, msname = job
+    with recording() as recorder:
+        try:
+            convert(_shared["args"], indata, msname, _shared["antenna_field"], _shared["station_cal"])
+            error = ""
+        except Exception as e:
+            logging.debug(traceback.format_exc())
+            error = "{}: {}".format(type(e).__name__, e)
+    return indata, msname, error, recorder.results()
+
+def write_timings(filename, outputs):
+    """Write stage timings to filename as JSON. outputs is a list of (inputs, output name, stages)."""
+    with open(filename, "w") as f:
+        json.dump({"outputs": [{"inputs": inputs, "output": output, "stages": stages}
+                               for inputs, output, stages in outputs]}, f, indent=2)
+
 def main():
     parser = create_parser()
     args = parser.parse_args()
@@ -40,15 +163,40 @@ def main():
         logging.basicConfig(format='%(levelname)s: %(message)s')
     else:
         logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
-    assert os.path.exists(args.indata)
-    
-    # MS name
-    if args.msname is None:
-        if args.indata.endswith(".dat"):
-            basename = args.indata[:-len(".dat")]
-        else:
-            basename = args.indata
-        args.msname = basename + ".ms"
+
+    # Inputs and MS names
+    patterns = args.indata
+    if args.msname is None and old_style_msname(patterns) is not None:
+        patterns, args.msname = patterns[:1], patterns[1]
+    inputs = expand_inputs(patterns)
+    missing = [] if args.follow else [indata for indata in inputs if not os.path.exists(indata)]
+    for indata in missing:
+        logging.error("Input file {} not found".format(indata))
+    if args.concat and missing:
+        sys.exit(1)
+    inputs = [indata for indata in inputs if indata not in missing]
+    if not inputs:
+        sys.exit(1)
+    extension = ".h5" if args.hdf5 else ".ms"
+    if args.concat and args.hdf5:
+        parser.error("--hdf5 can not be used with --concat")
+    if args.follow:
+        if args.concat or args.hdf5 or args.acc or args.aart or args.tbbxc:
+            parser.error("--follow only converts XST captures to a Measurement Set")
+        if len(inputs) != 1:
+            parser.error("--follow needs a single input file")
+        if args.subband < 0:
+            parser.error("--follow needs the XST subband (-s)")
+        args.xst = True
+    if args.concat:
+        if args.msname is None:
+            args.msname = default_msname(inputs[0])
+    elif args.msname is not None:
+        if len(inputs) != 1:
+            parser.error("--msname can only be used with a single input file")
+        jobs = [(inputs[0], args.msname)]
+    else:
+        jobs = [(indata, default_msname(indata, extension)) for indata in inputs]
 
     # Direction
     me = measures()
@@ -65,24 +213,65 @@ def main():
     if args.starttime != None:
         args.starttime = datetime.strptime(args.starttime, "%Y%m%d_%H%M%S")
 
-    # XST / ACC
-    if not args.xst and not args.acc and not args.aart and not args.tbbxc:
-        if re.match("^\d{8}_\d{6}_acc_512x192x192.dat$", os.path.basename(args.indata)):
-            logging.info("Assuming data is ACC based on filename")
-            args.acc = True
-        else:
-            logging.info("Data type not specified - assuming XST")
+    # Static inputs, parsed once for all files
+    antenna_field = {}
+    if args.antfield:
+        antenna_field = antfield.cached(args.antfield)
+        if args.stationname == "":
+            args.stationname = XCStationData._station_name_from_antfile(args.antfield)
+    elif args.stationname:
+        antenna_field = antfield.cached(XCStationData._antenna_field_path(args.stationname))
+    station_cal = stationcal.cached(args.stationcal) if args.stationcal else None
 
     # Convert
-    if args.acc:
-        station_data = ACCData(args.indata, args.rcumode, args.subband, args.antfield, args.starttime, args.direction, args.stationname)
-    elif args.aart:
-        station_data = AARTFAACData (args.indata, args.rcumode, args.subband,args.nchan, args.antfield, args.starttime, args.direction, args.stationname)
-    elif args.tbbxc:
-        station_data = TBBXCData(args.indata, args.rcumode, args.integration, args.antfield, args.starttime, args.direction, args.stationname)
+    if args.follow:
+        msname = args.msname if args.msname is not None else default_msname(inputs[0])
+        try:
+            with recording() as recorder:
+                n_block = follow_capture(args, inputs[0], msname, antenna_field, station_cal)
+            logging.info("Converted {} blocks of {} to {}".format(n_block, inputs[0], msname))
+        except KeyboardInterrupt:
+            logging.info("Stopped following {}".format(inputs[0]))
+        except Exception as e:
+            logging.debug(traceback.format_exc())
+            logging.error("Failed to convert {}: {}: {}".format(inputs[0], type(e).__name__, e))
+            sys.exit(1)
+        if args.timings:
+            write_timings(args.timings, [(inputs, msname, recorder.results())])
+        return
+    if args.concat:
+        try:
+            with recording() as recorder:
+                concatenate(args, inputs, args.msname, antenna_field, station_cal)
+        except Exception as e:
+            logging.debug(traceback.format_exc())
+            logging.error("Failed to concatenate into {}: {}: {}".format(args.msname, type(e).__name__, e))
+            sys.exit(1)
+        logging.info("Converted {} files to {}".format(len(inputs), args.msname))
+        if args.timings:
+            write_timings(args.timings, [(inputs, args.msname, recorder.results())])
+        return
+    if args.jobs > 1 and len(jobs) > 1:
+        pool = Pool(min(args.jobs, len(jobs)), initializer=_init_worker, initargs=(args, antenna_field, station_cal))
+        try:
+            results = list(pool.imap(_convert_job, jobs))
+        finally:
+            pool.close()
+            pool.join()
     else:
-        station_data = XSTData(args.indata, args.rcumode, args.subband, args.integration, args.antfield, args.starttime, args.direction, args.stationname)
+        _init_worker(args, antenna_field, station_cal)
+        results = [_convert_job(job) for job in jobs]
 
-    if args.stationcal:
-        station_data.set_station_cal(args.stationcal)
-    station_data.write_ms(args.msname, args.stationname)
+    failed = 0
+    for indata, msname, error, stages in results:
+        if error:
+            failed += 1
+            logging.error("Failed to convert {}: {}".format(indata, error))
+        else:
+            logging.info("Converted {} to {}".format(indata, msname))
+    if args.timings:
+        write_timings(args.timings, [([indata], msname, stages) for indata, msname, error, stages in results])
+    if len(results) + len(missing) > 1:
+        logging.info("{} of {} files converted".format(len(results) - failed, len(results) + len(missing)))
+    if failed or missing:
+        sys.exit(1)
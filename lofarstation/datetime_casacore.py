@@ -1,5 +1,8 @@
 import datetime
 import casacore.measures
+import numpy as np
+
+MJD_EPOCH = datetime.datetime(1858, 11, 17)
 
 class datetime_casacore(datetime.datetime):
     
@@ -9,14 +12,24 @@ class datetime_casacore(datetime.datetime):
     @classmethod
     def from_datetime(cls, dt):
         """Create from Python datetime object"""
-        fmt = "%Y-%m-%d-T%H:%M:%S.%f"
-        return cls.strptime(dt.strftime(fmt), fmt)
+        return cls(dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second, dt.microsecond)
     
+    @classmethod
+    def from_mjd_seconds(cls, mjd_seconds):
+        """Create from UTC seconds since MJD epoch, rounded to the microsecond"""
+        seconds = int(np.floor(mjd_seconds))
+        microseconds = int(round((mjd_seconds - seconds) * 1e6))
+        return cls.from_datetime(MJD_EPOCH + datetime.timedelta(seconds=seconds, microseconds=microseconds))
+
+    @classmethod
+    def list_from_mjd_seconds(cls, mjd_seconds):
+        """Create a list from an array of UTC seconds since MJD epoch"""
+        return [cls.from_mjd_seconds(t) for t in np.asarray(mjd_seconds, dtype=np.float64)]
+
     def mjd_seconds(self):
         """Returns seconds since MJD epoch"""
-        q = self.measures.get_value(self.epoch())
-        assert len(q) == 1
-        return q[0].get_value("s")
+        delta = self - MJD_EPOCH
+        return delta.days * 86400.0 + delta.seconds + delta.microseconds * 1e-6
     
     def epoch(self):
         """Returns a casacore epoch measures object"""
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""Build dynamic spectra (beamformed power per file and subband) from directories of
+ACC files using a pool of worker processes."""
+
+from __future__ import print_function
+from __future__ import absolute_import
+from .stationdata import ACCData, RCUMode
+from .stationcal import stationcal
+from . import antfield
+from multiprocessing import Pool
+import numpy as np
+import glob
+import logging
+import os.path
+
+# Static inputs shared by all files, set once per worker process
+_shared = {}
+
+
+def acc_files(accdir):
+    """Return the time ordered ACC files in accdir"""
+    return sorted(glob.glob(os.path.join(accdir, "*_acc_*.dat")))
+
+
+def _init_worker(shared):
+    _shared.update(shared)
+
+
+def _beam_power(job):
+    """Return the file index and the beamformed power per subband of one ACC file"""
+    index, accfile = job
+    try:
+        acc = ACCData(accfile, _shared["rcu_mode"], antfile=_shared["antenna_field"],
+                      station_name=_shared["station_name"])
+        acc.uvw_method = _shared["uvw_method"]
+        if _shared["station_cal"] is not None:
+            acc.set_station_cal(_shared["station_cal"])
+        power = acc.beam_power([_shared["direction"]])[0,:,0]
+        if power.shape != (RCUMode.n_subband,):
+            # A truncated file has fewer blocks than subbands
+            return index, None, "{} subbands instead of {}".format(len(power), RCUMode.n_subband)
+        return index, power, ""
+    except Exception as e:
+        return index, None, "{}: {}".format(type(e).__name__, e)
+
+
+def dynamic_spectrum(accfiles, rcu_mode, direction, station_name="", antfile="", calfile="",
+                     out=None, n_proc=None, uvw_method="exact"):
+    """Return the beamformed power towards direction for each of accfiles and every subband,
+    an array of shape n_file * n_subband. Files are processed in parallel by n_proc worker
+    processes (default: one per CPU). The AntennaField and station cal are parsed once and
+    shared with the workers. If out is a file name the result is streamed into a .npy file
+    of that name as files complete, otherwise it is returned in memory. Rows of files that
+    could not be processed are NaN."""
+    if antfile == "":
+        if station_name == "":
+            raise ValueError("Cannot set AntennaField, antfile or station name should be set")
+        antfile = ACCData._antenna_field_path(station_name)
+    shared = {"rcu_mode": rcu_mode, "direction": direction, "station_name": station_name,
+              "antenna_field": antfield.cached(antfile), "uvw_method": uvw_method,
+              "station_cal": stationcal.cached(calfile) if calfile else None}
+
+    shape = (len(accfiles), RCUMode.n_subband)
+    if out is None:
+        dyn_spec = np.empty(shape, dtype=np.float64)
+    else:
+        dyn_spec = np.lib.format.open_memmap(out, mode="w+", dtype=np.float64, shape=shape)
+
+    pool = Pool(n_proc, initializer=_init_worker, initargs=(shared,))
+    try:
+        for index, power, error in pool.imap_unordered(_beam_power, enumerate(accfiles)):
+            if power is None:
+                logging.warning("Failed to process {}: {}".format(accfiles[index], error))
+                dyn_spec[index] = np.nan
+            else:
+                logging.info("Processed {}".format(accfiles[index]))
+                dyn_spec[index] = power
+    finally:
+        pool.close()
+        pool.join()
+
+    if out is not None:
+        dyn_spec.flush()
+    return dyn_spec
@@ -0,0 +1,92 @@
+"""Convert an XST capture while it is being written.
+
+follow polls the size of the capture file and loads each run of new complete
+blocks as a separate XCStationData, so UVWs and calibration are only calculated
+for the new blocks and memory use does not grow with the length of the capture.
+Each batch is passed to a sink, an object with append(station_data) and close()
+methods. MSSink appends the rows to a Measurement Set that is flushed after every
+batch, so they can be read while the capture continues."""
+
+from __future__ import absolute_import
+from __future__ import division
+from .stationdata import DEFAULT_CHUNK_SIZE
+from .instrumentation import span
+import numpy as np
+import logging
+import os.path
+import time
+
+POLL_INTERVAL = 1.0 # Seconds between checks for new blocks
+DEFAULT_IDLE_TIMEOUT = 60.0 # Seconds without new blocks after which the capture is assumed complete
+
+
+class MSSink(object):
+    """Appends station data to a Measurement Set, created when the first data is appended.
+    The sub tables are written from the first data and the OBSERVATION time range is
+    extended with every append."""
+    def __init__(self, ms_name, station_name="", chunk_size=DEFAULT_CHUNK_SIZE, layout="default"):
+        self.ms_name = ms_name
+        self.station_name = station_name
+        self.chunk_size = chunk_size
+        self.layout = layout
+        self.ms = None
+        self.time_range = None
+
+    def append(self, station_data):
+        if self.ms is None:
+            logging.info("Creating Measurement Set {}".format(self.ms_name))
+            self.ms = station_data._create_ms(self.ms_name, self.layout)
+        time_first, time_last = station_data._append_main(self.ms, self.chunk_size)
+        if self.time_range is None:
+            self.time_range = [time_first, time_last]
+            with span("subtables"):
+                station_data._write_subtables(self.ms, self.station_name, self.time_range)
+        else:
+            self.time_range[1] = time_last
+            self.ms.observation.putcell("TIME_RANGE", 0, np.array(self.time_range))
+        self.ms.flush()
+
+    def close(self):
+        if self.ms is not None:
+            self.ms.flush()
+        self.ms = None
+
+
+def follow(datafile, load, sink, max_blocks=DEFAULT_CHUNK_SIZE, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+           poll_interval=POLL_INTERVAL, stop=None):
+    """Pass the blocks of the raw XST file datafile to sink as they are written.
+    load(first_block, n_blocks) returns the XCStationData of those blocks, n_blocks=0 is
+    used once to find the block size. At most max_blocks are loaded at a time. Returns the
+    number of blocks converted once no new block has appeared for idle_timeout seconds,
+    or stop (a threading.Event) is set. The file does not need to exist yet."""
+    next_block = 0
+    block_bytes = None
+    last_change = time.time()
+    try:
+        while stop is None or not stop.is_set():
+            n_new = 0
+            if os.path.exists(datafile):
+                if block_bytes is None:
+                    block_bytes = load(0, 0).block_bytes
+                n_new = min(os.path.getsize(datafile) // block_bytes - next_block, max_blocks)
+            if n_new > 0:
+                station_data = load(next_block, n_new)
+                with span("follow") as s:
+                    sink.append(station_data)
+                    s.nbytes = n_new * block_bytes
+                logging.info("Converted blocks {}..{} of {}".format(next_block, next_block + n_new - 1, datafile))
+                next_block += n_new
+                last_change = time.time()
+                del station_data
+                continue # Catch up without waiting if more blocks are ready
+            if time.time() - last_change > idle_timeout:
+                logging.info("No new blocks in {} for {:g} seconds".format(datafile, idle_timeout))
+                break
+            time.sleep(poll_interval)
+    finally:
+        sink.close()
+    if block_bytes is not None and os.path.exists(datafile):
+        remainder = os.path.getsize(datafile) % block_bytes
+        if remainder != 0:
+            logging.warning("{} has {} trailing bytes that do not form a complete block".format(datafile, remainder))
+    return next_block
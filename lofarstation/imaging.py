@@ -0,0 +1,263 @@
+"""All-sky images from station correlation matrices.
+
+Pixels form a regular l,m grid spaced 2/n_pixel with l = m = 0 (the zenith of the
+field) at pixel n_pixel // 2, in the station's local frame: the p and q axes of the
+AntennaField ROTATION_MATRIX of the band. The horizon is the inscribed circle and pixels
+below it are NaN. A pixel is the power beamformed towards it, w^H R w, from station_data
+(the raw data with the direction independent cals applied) for one polarisation,
+normalised by n_ant**2 as in XCStationData.beam_power.
+
+images() evaluates this directly. Steering matrices, the antenna * pixel phases for one
+frequency, are cached per station, band, frequency and image size, and all blocks and
+channels at the same frequency, e.g. every block of an XST capture, are imaged together
+with one matrix product. The cost grows with pixels * antennas**2 * blocks.
+
+fft_images() grids the packed baselines with a Kaiser-Bessel kernel and Fourier transforms
+the grids, so the cost grows with pixels * log(pixels) + baselines * blocks instead. It
+leaves out the small height (r) differences of the antennas, so it agrees with images()
+to the accuracy of the gridding, ~1e-3 of the peak."""
+
+from __future__ import absolute_import
+from __future__ import division
+from .stationdata import XCStationData, C
+from .packing import packing_plan
+from .instrumentation import span
+from collections import OrderedDict
+import numpy as np
+
+DEFAULT_N_PIXEL = 128
+CACHE_SIZE = 16 # Steering matrices kept by steering_matrix
+MAX_CHUNK_BYTES = 256 * 1024 * 1024 # Intermediate product of one matrix product
+POLARISATIONS = {"XX": [0], "YY": [1], "I": [0, 1]} # I is the mean of XX and YY
+KERNEL_SUPPORT = 7 # Grid cells, odd
+KERNEL_OVERSAMPLE = 64 # Samples per grid cell of the tabulated kernel
+GRID_PADDING = 2 # The grid spans GRID_PADDING times the l,m range of the image
+# Kaiser-Bessel shape for KERNEL_SUPPORT and GRID_PADDING (Beatty et al. 2005)
+KERNEL_BETA = np.pi * np.sqrt((KERNEL_SUPPORT / GRID_PADDING)**2 * (GRID_PADDING - 0.5)**2 - 0.8)
+
+# (station, band, frequency, n_pixel, antenna positions): steering matrix, least recently used first
+_cache = OrderedDict()
+# (station, band, frequency, n_grid, antenna positions): gridding plan, least recently used first
+_plans = OrderedDict()
+_kernel_table = {}
+
+
+def lm_grid(n_pixel=DEFAULT_N_PIXEL):
+    """Return l and m of each pixel, n_pixel * n_pixel arrays with m along the first axis,
+    and the mask of the pixels above the horizon"""
+    axis = (np.arange(n_pixel) - n_pixel // 2) * (2.0 / n_pixel)
+    m, l = np.meshgrid(axis, axis, indexing="ij")
+    return l, m, l**2 + m**2 < 1.0
+
+
+def local_positions(station_data):
+    """Return the antenna positions relative to the station position in the local p, q, r
+    frame of the band (antenna * 3). ROTATION_MATRIX has the p, q and r axes in ITRF as columns."""
+    rotation = np.asarray(station_data.antenna_field["ROTATION_MATRIX"][station_data.rcu_mode.band])
+    return (station_data.antenna_positions - station_data.position).dot(rotation)
+
+
+def steering_matrix(station_data, frequency, n_pixel=DEFAULT_N_PIXEL):
+    """Return the geometric phases (antenna * pixel above the horizon) steering the station
+    towards each pixel at frequency. Matrices are cached and shared, do not modify them."""
+    positions = local_positions(station_data)
+    key = (station_data.station_name, station_data.rcu_mode.band, float(frequency), n_pixel, positions.tobytes())
+    steering = _cache.pop(key, None)
+    if steering is None:
+        l, m, above = lm_grid(n_pixel)
+        lmn = np.array([l[above], m[above], np.sqrt(1.0 - l[above]**2 - m[above]**2)])
+        steering = XCStationData.complex_phase(positions.dot(lmn) * frequency / C)
+        steering.flags.writeable = False
+        while len(_cache) >= CACHE_SIZE:
+            _cache.popitem(last=False)
+    _cache[key] = steering
+    return steering
+
+
+def _image_power(acm, steering, exclude_autos):
+    """Return sum_ij w_i R_ij conj(w_j) for every R in acm (n * antenna * antenna) and every
+    column w of steering, as sum_j conj(w_j) (R^T w)_j so steering needs no conjugate"""
+    n, n_ant = acm.shape[:2]
+    product = np.ascontiguousarray(acm.transpose((0, 2, 1))).reshape((n * n_ant, n_ant)).dot(steering)
+    # The real part of conj(w) * product is the sum of the products of the interleaved float parts
+    power = np.einsum("ak,nak->nk", steering.view(np.float64), product.reshape((n, n_ant, -1)).view(np.float64))
+    power = power.reshape((n, -1, 2)).sum(axis=2)
+    if exclude_autos:
+        # |w_a| = 1, so the autocorrelations add the trace of R to every pixel
+        power -= np.trace(acm, axis1=1, axis2=2).real[:,np.newaxis]
+    return power
+
+
+def images(station_data, n_pixel=DEFAULT_N_PIXEL, polarisation="I", exclude_autos=True, blocks=None):
+    """Return all-sky images of station_data, shape block * channel * n_pixel * n_pixel, with
+    m along the third and l along the last axis (see lm_grid). polarisation is XX, YY or I.
+    blocks selects blocks (an index, slice or array), default all. Autocorrelations are left
+    out unless exclude_autos is False."""
+    if polarisation not in POLARISATIONS:
+        raise ValueError("Unknown polarisation {}, choose from {}".format(polarisation, ", ".join(sorted(POLARISATIONS))))
+    sd = station_data
+    blocks = np.atleast_1d(np.arange(sd.n_block)[slice(None) if blocks is None else blocks])
+    pols = POLARISATIONS[polarisation]
+    n_ant = sd.n_ant
+    above = lm_grid(n_pixel)[2].reshape(-1)
+    pixels = np.flatnonzero(above)
+    result = np.full((len(blocks), sd.n_channel, n_pixel * n_pixel), np.nan)
+    acms = sd.station_data
+    frequency = sd.frequency[sd.subband_id[blocks]] # block * channel
+    chunk_size = max(1, MAX_CHUNK_BYTES // (n_ant * len(pixels) * np.dtype(np.complex128).itemsize))
+    with span("images") as s:
+        for f in np.unique(frequency):
+            steering = steering_matrix(sd, f, n_pixel)
+            block_index, channel = np.nonzero(frequency == f)
+            for start in range(0, len(block_index), chunk_size):
+                b = block_index[start:start + chunk_size]
+                c = channel[start:start + chunk_size]
+                if sd.packed_storage:
+                    acm = sd._expand_blocks(acms[blocks[b]])[np.arange(len(b)),:,:,c]
+                else:
+                    acm = acms[blocks[b],:,:,c] # n * input * input
+                # The image is linear in R, so polarisations are summed before imaging
+                acm = sum(acm[:,p::sd.n_pol,p::sd.n_pol] for p in pols)
+                power = _image_power(acm, steering, exclude_autos)
+                result[b[:,np.newaxis],c[:,np.newaxis],pixels] = power / (len(pols) * n_ant**2)
+        s.nbytes = acms.nbytes
+    return result.reshape((len(blocks), sd.n_channel, n_pixel, n_pixel))
+
+
+def _kernel(x):
+    """Kaiser-Bessel gridding kernel at x grid cells from its centre"""
+    x = np.clip(2.0 * x / KERNEL_SUPPORT, -1.0, 1.0)
+    return np.i0(KERNEL_BETA * np.sqrt(1.0 - x**2)) / np.i0(KERNEL_BETA)
+
+
+def _kernel_weights(x):
+    """The gridding kernel at x (|x| <= KERNEL_SUPPORT / 2), linearly interpolated from a
+    table made once per process"""
+    if "kernel" not in _kernel_table:
+        n = KERNEL_SUPPORT * KERNEL_OVERSAMPLE
+        # One extra sample so the last interval can be interpolated
+        _kernel_table["kernel"] = _kernel(np.arange(n + 2) / float(KERNEL_OVERSAMPLE) - KERNEL_SUPPORT / 2.0)
+    table = _kernel_table["kernel"]
+    pos = (x + KERNEL_SUPPORT / 2.0) * KERNEL_OVERSAMPLE
+    index = pos.astype(np.int64)
+    frac = pos - index
+    return table[index] * (1.0 - frac) + table[index + 1] * frac
+
+
+def _grid_correction(nu):
+    """Fourier transform of the kernel at nu cycles per grid cell, to divide the image by"""
+    x = np.linspace(-KERNEL_SUPPORT / 2.0, KERNEL_SUPPORT / 2.0, 1001)
+    return (_kernel(x) * np.cos(2 * np.pi * np.outer(nu, x))).sum(axis=1) * (x[1] - x[0])
+
+
+def _cross_baselines(station_data):
+    """Return the indices of the cross correlation baselines in MS order and their p, q
+    lengths (baseline * 2) in m"""
+    plan = packing_plan(station_data.n_ant, 1, 1)
+    cross = np.flatnonzero(plan.ant1 != plan.ant2)
+    positions = local_positions(station_data)
+    return cross, positions[plan.ant1[cross],:2] - positions[plan.ant2[cross],:2]
+
+
+def grid_size(station_data, n_pixel=DEFAULT_N_PIXEL, frequency=None):
+    """Return the side of the uv grid used by fft_images, GRID_PADDING * n_pixel times the
+    smallest power of two for which the longest baseline at frequency (default the highest
+    frequency of station_data) and the kernel fit on the grid"""
+    if frequency is None:
+        frequency = station_data.frequency.max()
+    baselines = _cross_baselines(station_data)[1]
+    # Grid cells are 1 / (2 * GRID_PADDING) wavelengths, so the image spans l = -1..1
+    extent = np.abs(baselines).max() * frequency / C * 2 * GRID_PADDING + KERNEL_SUPPORT // 2 + 1
+    oversample = 1
+    while GRID_PADDING * n_pixel * oversample // 2 < extent:
+        oversample *= 2
+    return GRID_PADDING * n_pixel * oversample
+
+
+def gridding_plan(station_data, frequency, n_grid):
+    """Return the flat grid cells and kernel weights (cross baseline * KERNEL_SUPPORT**2) that
+    grid the cross correlations at frequency on an n_grid * n_grid grid. Plans are cached
+    and shared, do not modify them."""
+    positions = local_positions(station_data)
+    key = (station_data.station_name, station_data.rcu_mode.band, float(frequency), n_grid, positions.tobytes())
+    plan = _plans.pop(key, None)
+    if plan is None:
+        baselines = _cross_baselines(station_data)[1]
+        uv = baselines * frequency / C * 2 * GRID_PADDING # grid cell coordinates
+        taps = np.arange(KERNEL_SUPPORT) - KERNEL_SUPPORT // 2
+        cells = np.round(uv).astype(np.int64)[:,:,np.newaxis] + taps # baseline * (u, v) * tap
+        weights = _kernel_weights(cells - uv[:,:,np.newaxis])
+        cells %= n_grid # FFT order, the origin is cell 0
+        cells = (cells[:,1,:,np.newaxis] * n_grid + cells[:,0,np.newaxis,:]).reshape((len(uv), -1))
+        weights = (weights[:,1,:,np.newaxis] * weights[:,0,np.newaxis,:]).reshape((len(uv), -1))
+        plan = (cells, weights)
+        while len(_plans) >= CACHE_SIZE:
+            _plans.popitem(last=False)
+    _plans[key] = plan
+    return plan
+
+
+def _grid(vis, plan, grids):
+    """Add vis (n * cross baseline) to grids (n * n_grid**2) with a gridding plan"""
+    cells, weights = plan
+    n, n_cells = grids.shape
+    index = (cells[np.newaxis] + (np.arange(n) * n_cells)[:,np.newaxis,np.newaxis]).reshape(-1)
+    values = (vis[:,:,np.newaxis] * weights).reshape(-1)
+    grids += np.bincount(index, values.real, minlength=grids.size).reshape(grids.shape)
+    grids += 1j * np.bincount(index, values.imag, minlength=grids.size).reshape(grids.shape)
+
+
+def fft_images(station_data, n_pixel=DEFAULT_N_PIXEL, polarisation="I", exclude_autos=True, blocks=None):
+    """Return all-sky images of station_data made by gridding and FFT, like images(): shape
+    block * channel * n_pixel * n_pixel with m along the third and l along the last axis.
+    The packed cross correlations of each block and channel are gridded with the cached
+    plan for their frequency, and up to MAX_CHUNK_BYTES of grids, of any frequencies,
+    are transformed together with one batched FFT."""
+    if polarisation not in POLARISATIONS:
+        raise ValueError("Unknown polarisation {}, choose from {}".format(polarisation, ", ".join(sorted(POLARISATIONS))))
+    sd = station_data
+    blocks = np.atleast_1d(np.arange(sd.n_block)[slice(None) if blocks is None else blocks])
+    pol_pairs = [p * (sd.n_pol + 1) for p in POLARISATIONS[polarisation]] # XX and YY of the MS order pol pairs
+    plan = packing_plan(sd.n_ant, sd.n_pol, 1)
+    cross = _cross_baselines(sd)[0]
+    autos = np.flatnonzero(plan.ant1 == plan.ant2)
+    n_grid = grid_size(sd, n_pixel)
+    # Image pixels on the grid's (finer) pixels, in FFT order, and the grid correction there
+    offset = (np.arange(n_pixel) - n_pixel // 2) * (n_grid // (GRID_PADDING * n_pixel))
+    pixels = offset % n_grid
+    correction = _grid_correction(offset / float(n_grid))
+    correction = np.outer(correction, correction)
+    above = lm_grid(n_pixel)[2]
+
+    frequency = sd.frequency[sd.subband_id[blocks]] # block * channel
+    block_index, channel = np.nonzero(np.ones(frequency.shape, dtype=bool))
+    order = np.argsort(frequency[block_index, channel], kind="mergesort") # Group by frequency
+    block_index, channel = block_index[order], channel[order]
+    bytes_per_image = max(n_grid**2 * np.dtype(np.complex128).itemsize, len(cross) * KERNEL_SUPPORT**2 * 32)
+    chunk_size = max(1, MAX_CHUNK_BYTES // bytes_per_image)
+    acms = sd.station_data
+    result = np.full((len(blocks), sd.n_channel, n_pixel, n_pixel), np.nan)
+    with span("fft_images") as s:
+        for start in range(0, len(block_index), chunk_size):
+            b = block_index[start:start + chunk_size]
+            c = channel[start:start + chunk_size]
+            if sd.packed_storage:
+                packed = acms[blocks[b],:,c,:] # n * baseline * pol pair
+            else:
+                packed = plan.pack(acms[blocks[b],:,:,c][...,np.newaxis])[:,:,0,:]
+            vis = sum(packed[:,:,q] for q in pol_pairs)
+            grids = np.zeros((len(b), n_grid * n_grid), dtype=np.complex128)
+            f = frequency[b, c]
+            # Images are ordered by frequency, grid each run of one frequency with its plan
+            runs = np.append(np.flatnonzero(np.append(True, f[1:] != f[:-1])), len(f))
+            for i, j in zip(runs[:-1], runs[1:]):
+                _grid(vis[i:j,cross], gridding_plan(sd, f[i], n_grid), grids[i:j])
+            sky = np.fft.fft2(grids.reshape((-1, n_grid, n_grid)))[:,pixels[:,np.newaxis],pixels]
+            # Each cross correlation also stands for its conjugate baseline
+            power = 2 * sky.real / correction
+            if not exclude_autos:
+                power += vis[:,autos].real.sum(axis=1)[:,np.newaxis,np.newaxis]
+            power[:,~above] = np.nan
+            result[b,c] = power / (len(pol_pairs) * sd.n_ant**2)
+        s.nbytes = acms.nbytes
+    return result
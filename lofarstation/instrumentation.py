@@ -0,0 +1,156 @@
+"""Per stage timing and memory instrumentation.
+
+Processing stages are wrapped in spans, which record the wall time, the bytes
+processed (set by the stage), the change in resident memory (RSS) from the start
+to the end of the stage and the process peak RSS when the stage finished:
+
+    with span("packed_data") as s:
+        data = ...
+        s.nbytes = data.nbytes
+
+Finished spans are passed to listeners, any callable taking a Span. With no
+listener installed a span only costs a list check. recording() installs a
+Recorder, which totals the spans by name, for the duration of a block:
+
+    with recording() as recorder:
+        station_data.write_ms("out.ms")
+    recorder.write_json("timings.json")
+
+Span names nest: a span opened while write_ms is running is named write_ms/putcol.
+Nesting is tracked per thread. The process peak RSS is a lifetime high-water mark,
+so it only shows which stage first reached a new peak. The current RSS used for the
+change is read from /proc and is not recorded on other platforms."""
+
+from __future__ import absolute_import
+from __future__ import division
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import logging
+import os
+import sys
+import threading
+import time
+try:
+    import resource
+except ImportError:
+    resource = None # Not available on Windows, peak RSS is not recorded
+
+try:
+    PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+except (AttributeError, ValueError, OSError):
+    PAGE_SIZE = 4096
+_listeners = []
+_local = threading.local()
+
+
+def rss_mb():
+    """Return the current resident set size of this process in MB, or None if unknown"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE / 1e6
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def max_rss_mb():
+    """Return the peak resident set size of this process so far in MB, or None if unknown"""
+    if resource is None:
+        return None
+    scale = 1e6 if sys.platform == "darwin" else 1e3 # ru_maxrss is bytes on macOS, kB elsewhere
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+class Span(object):
+    """A finished (or running) stage: name including enclosing spans, wall time in seconds,
+    bytes processed, change in RSS over the stage and process peak RSS at the end of the
+    stage, both in MB"""
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.nbytes = 0
+        self.rss_delta_mb = None
+        self.process_peak_rss_mb = None
+
+
+_disabled = Span("")
+
+
+@contextmanager
+def span(name):
+    """Time the enclosed block as stage name, yielding the Span so the stage can set nbytes"""
+    if not _listeners:
+        yield _disabled
+        return
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    s = Span("/".join(stack + [name]))
+    stack.append(name)
+    rss0 = rss_mb()
+    t0 = time.time()
+    try:
+        yield s
+    finally:
+        s.seconds = time.time() - t0
+        stack.pop()
+        rss1 = rss_mb()
+        if rss0 is not None and rss1 is not None:
+            s.rss_delta_mb = rss1 - rss0
+        s.process_peak_rss_mb = max_rss_mb()
+        for listener in list(_listeners):
+            listener(s)
+
+
+def add_listener(listener):
+    _listeners.append(listener)
+
+
+def remove_listener(listener):
+    _listeners.remove(listener)
+
+
+class Recorder(object):
+    """Listener that totals spans by name: calls, seconds, bytes, the largest change in RSS
+    over one call and the largest process peak RSS"""
+    def __init__(self):
+        self.stages = OrderedDict()
+
+    def __call__(self, s):
+        stage = self.stages.get(s.name)
+        if stage is None:
+            stage = self.stages[s.name] = {"stage": s.name, "calls": 0, "seconds": 0.0, "bytes": 0,
+                                           "rss_delta_mb": None, "process_peak_rss_mb": None}
+        stage["calls"] += 1
+        stage["seconds"] += s.seconds
+        stage["bytes"] += s.nbytes
+        for key in ("rss_delta_mb", "process_peak_rss_mb"):
+            value = getattr(s, key)
+            if value is not None:
+                stage[key] = max(stage[key], value) if stage[key] is not None else value
+
+    def results(self):
+        """Return the stage totals as a list of dicts, in the order the stages first finished"""
+        return [dict(stage) for stage in self.stages.values()]
+
+    def log(self, level=logging.INFO):
+        for stage in self.stages.values():
+            logging.log(level, "{stage}: {calls} calls, {seconds:.3f} s, {mb:.1f} MB, RSS change {delta} MB, process peak RSS {peak} MB".format(
+                mb=stage["bytes"] / 1e6, delta="?" if stage["rss_delta_mb"] is None else "{:+.0f}".format(stage["rss_delta_mb"]),
+                peak="?" if stage["process_peak_rss_mb"] is None else "{:.0f}".format(stage["process_peak_rss_mb"]), **stage))
+
+    def write_json(self, filename):
+        with open(filename, "w") as f:
+            json.dump({"stages": self.results()}, f, indent=2)
+
+
+@contextmanager
+def recording(recorder=None):
+    """Install recorder (a new Recorder by default) as a listener for the enclosed block and yield it"""
+    if recorder is None:
+        recorder = Recorder()
+    add_listener(recorder)
+    try:
+        yield recorder
+    finally:
+        remove_listener(recorder)
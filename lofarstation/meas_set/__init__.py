@@ -1,2 +1,3 @@
 from __future__ import absolute_import
 from .measurement_set import MeasurementSet, DefinedTable
+from .storage_layouts import storage_layouts, incremental_columns
@@ -3,16 +3,23 @@ from casacore.tables import table, makescacoldesc, makearrcoldesc, maketabdesc
 import numpy as np
 import os
 from .ms_table_defs import ms_table_defs
+from .storage_layouts import main_table_layout
+from ..instrumentation import span
 
 class DefinedTable(object):
-    def __init__(self, tab_type, location="", out_name=None):
+    def __init__(self, tab_type, location="", out_name=None, desc=None, dminfo=None):
+        """desc and dminfo replace the table description and data manager info of ms_table_defs"""
         self.type = tab_type
         if out_name is None:
             out_name = self.type
         if location != "":
             out_name = location + os.sep + out_name
         td = ms_table_defs[self.type]
-        self.table = table(out_name, td["desc"], ack=False)
+        if desc is None:
+            desc = td["desc"]
+        if dminfo is None:
+            dminfo = {}
+        self.table = table(out_name, desc, ack=False, dminfo=dminfo)
         self.table.putinfo(td["info"])
         self.table.putkeywords(td["keywords"])
         for col, keywords in td["col_keywords"].items():
@@ -23,11 +30,24 @@ class MeasurementSet(object):
         components = snake_str.split('_')
         return components[0].lower() + "".join(x.title() for x in components[1:])
 
-    def __init__(self, msname):
-        self.table = DefinedTable("MAIN", location=msname, out_name="").table
-        self.main = self.table
-        # TODO: Submit OrderedDict patch in tables.py
-        sub_tables = [k for k in ms_table_defs if k != "MAIN"]
-        for subt in sub_tables:
-            self.table.putkeyword(subt, "Table: " + DefinedTable(subt, location=self.table.name()).table.name())
-            setattr(self, self._to_camel_case(subt), table(self.table.getkeyword(subt), readonly=False, ack=False))
+    def __init__(self, msname, layout="default", data_shape=None, n_baseline=None):
+        """layout is a storage layout profile for the MAIN table (see storage_layouts).
+        Profiles other than default need the shape of a DATA cell (n_channel, n_pol)
+        and the number of baselines per integration."""
+        with span("create_ms"):
+            desc, dminfo = main_table_layout(layout, data_shape, n_baseline)
+            self.table = DefinedTable("MAIN", location=msname, out_name="", desc=desc, dminfo=dminfo).table
+            self.main = self.table
+            # TODO: Submit OrderedDict patch in tables.py
+            sub_tables = [k for k in ms_table_defs if k != "MAIN"]
+            for subt in sub_tables:
+                self.table.putkeyword(subt, "Table: " + DefinedTable(subt, location=self.table.name()).table.name())
+                setattr(self, self._to_camel_case(subt), table(self.table.getkeyword(subt), readonly=False, ack=False))
+            self._sub_tables = [self._to_camel_case(subt) for subt in sub_tables]
+
+    def flush(self):
+        """Write the MAIN table and the sub tables to disk"""
+        with span("flush"):
+            for subt in self._sub_tables:
+                getattr(self, subt).flush()
+            self.main.flush()
@@ -0,0 +1,78 @@
+"""Storage layout profiles for the MAIN table.
+
+A profile chooses the storage manager of the MAIN columns and the shape of
+their tiles. Tile shapes are given in rows and sized from the data shape, so a
+profile works for any number of channels, polarisations and baselines.
+  default: the ms_table_defs layout. DATA has a TiledShapeStMan with casacore's
+           default tile shape and all other columns use StandardStMan.
+  tiled:   DATA, FLAG, UVW, WEIGHT and SIGMA in TiledColumnStMan. Each tile holds
+           every baseline of one integration, for fast writing and time ordered reads,
+           unless that would make DATA tiles larger than MAX_TILE_BYTES.
+  tiled_small: As tiled but with tiles of SMALL_TILE_ROWS rows, so reading a
+           single baseline reads less unused data.
+  compact: DATA and UVW tiled as in tiled. Columns that are constant, or constant
+           for an integration, use IncrementalStMan. Only the rows where a value
+           changes are stored and need to be written (see incremental_columns)."""
+
+from __future__ import absolute_import
+from casacore.tables import makedminfo
+import copy
+import numpy as np
+from .ms_table_defs import ms_table_defs
+
+SMALL_TILE_ROWS = 256
+MAX_TILE_BYTES = 4 * 1024 * 1024 # Of a DATA tile
+TILED_COLUMNS = ("DATA", "FLAG", "UVW", "WEIGHT", "SIGMA")
+INCREMENTAL_COLUMNS = ("TIME", "TIME_CENTROID", "INTERVAL", "EXPOSURE", "DATA_DESC_ID", "FLAG", "WEIGHT", "SIGMA",
+                       "FLAG_ROW", "ARRAY_ID", "OBSERVATION_ID", "STATE_ID", "PROCESSOR_ID", "FEED1", "FEED2",
+                       "FIELD_ID", "SCAN_NUMBER")
+
+# name: columns to tile, rows per tile (None for one integration, n_baseline rows) and
+# columns to store incrementally, or None for the ms_table_defs layout
+storage_layouts = {
+    "default": None,
+    "tiled": {"tiled": TILED_COLUMNS, "tile_rows": None, "incremental": ()},
+    "tiled_small": {"tiled": TILED_COLUMNS, "tile_rows": SMALL_TILE_ROWS, "incremental": ()},
+    "compact": {"tiled": ("DATA", "UVW"), "tile_rows": None, "incremental": INCREMENTAL_COLUMNS},
+}
+
+
+def incremental_columns(tab):
+    """Return the set of columns of table tab that are stored with IncrementalStMan.
+    A value written to one of these holds for the following rows until the next value
+    written, so constant values only need writing at the first row they apply to."""
+    return set(col for dm in tab.getdminfo().values() if dm["TYPE"] == "IncrementalStMan"
+               for col in dm["COLUMNS"])
+
+
+def main_table_layout(layout, data_shape=None, n_baseline=None):
+    """Return the MAIN table description and data manager info for layout. Profiles
+    other than default need the shape of a DATA cell, (n_channel, n_pol), and the
+    number of baselines (rows) per integration."""
+    if layout not in storage_layouts:
+        raise ValueError("Unknown storage layout {}, choose from {}".format(layout, ", ".join(sorted(storage_layouts))))
+    desc = ms_table_defs["MAIN"]["desc"]
+    profile = storage_layouts[layout]
+    if profile is None:
+        return desc, {}
+    if data_shape is None or n_baseline is None:
+        raise ValueError("Storage layout {} needs data_shape and n_baseline".format(layout))
+    n_channel, n_pol = data_shape
+    desc = copy.deepcopy(desc)
+    tile_rows = profile["tile_rows"] or n_baseline
+    tile_rows = max(1, min(tile_rows, MAX_TILE_BYTES // (n_channel * n_pol * np.dtype(np.complex64).itemsize)))
+    # Cell shapes in C order (as described) and tile shapes in casacore (Fortran) order
+    cell_shapes = {"DATA": [n_channel, n_pol], "FLAG": [n_channel, n_pol], "UVW": [3],
+                   "WEIGHT": [n_pol], "SIGMA": [n_pol]}
+    group_spec = {}
+    for column in profile["tiled"]:
+        group = "Tiled" + column.title()
+        desc[column].update({"dataManagerType": "TiledColumnStMan", "dataManagerGroup": group,
+                             "option": 5, "shape": np.array(cell_shapes[column], dtype=np.int32)})
+        tile_shape = cell_shapes[column][::-1] + [tile_rows]
+        group_spec[group] = {"DEFAULTTILESHAPE": np.array(tile_shape, dtype=np.int32)}
+    for column in profile["incremental"]:
+        desc[column].update({"dataManagerType": "IncrementalStMan", "dataManagerGroup": "IncrementalStMan"})
+        if column in cell_shapes:
+            desc[column].update({"option": 5, "shape": np.array(cell_shapes[column], dtype=np.int32)})
+    return desc, makedminfo(desc, group_spec)
@@ -0,0 +1,67 @@
+"""Packing of full correlation matrices into Measurement Set baseline order.
+
+A PackingPlan holds precomputed flat gather indices so a block of full matrices
+is packed with a single np.take, optionally straight into an output buffer.
+Plans are cached per (n_ant, n_pol, n_channel) and shared by all users in a process."""
+
+import numpy as np
+
+
+class PackingPlan(object):
+    """Gather indices from full correlation matrices (block * input * input * channel,
+    inputs ordered antenna, polarisation) to MS order (block * baseline * channel * pol pair).
+    Baselines are the upper triangle of the antenna matrix, autos included."""
+    def __init__(self, n_ant, n_pol, n_channel):
+        self.n_ant = n_ant
+        self.n_pol = n_pol
+        self.n_channel = n_channel
+        self.ant1, self.ant2 = np.triu_indices(n_ant)
+        self.n_baseline = len(self.ant1)
+        n_inputs = n_ant * n_pol
+        a1 = self.ant1[:,np.newaxis,np.newaxis,np.newaxis]
+        a2 = self.ant2[:,np.newaxis,np.newaxis,np.newaxis]
+        chan = np.arange(n_channel)[np.newaxis,:,np.newaxis,np.newaxis]
+        p = np.arange(n_pol)[np.newaxis,np.newaxis,:,np.newaxis]
+        q = np.arange(n_pol)[np.newaxis,np.newaxis,np.newaxis,:]
+        # Flat positions of (ant1, p, ant2, q, channel) and its conjugate (ant2, q, ant1, p, channel)
+        self.index = (((a1 * n_pol + p) * n_inputs + a2 * n_pol + q) * n_channel + chan).reshape(-1)
+        self.conj_index = (((a2 * n_pol + q) * n_inputs + a1 * n_pol + p) * n_channel + chan).reshape(-1)
+        self.block_size = n_inputs * n_inputs * n_channel
+        self.packed_shape = (self.n_baseline, n_channel, n_pol * n_pol)
+
+    def pack(self, data, out=None):
+        """Return data (block * input * input * channel) in MS order, block * baseline * channel * pol pair.
+        If out is given, an array of that shape or its MS row shape (rows * channel * pol pair), the
+        result is gathered directly into it."""
+        flat = data.reshape((-1,self.block_size))
+        shape = (flat.shape[0],) + self.packed_shape
+        if out is None:
+            out = np.empty(shape=shape, dtype=data.dtype)
+        if out.dtype == data.dtype and out.flags.c_contiguous:
+            np.take(flat, self.index, axis=1, out=out.reshape((flat.shape[0],-1)), mode="clip")
+        else:
+            out.reshape(shape)[...] = np.take(flat, self.index, axis=1).reshape(shape)
+        return out.reshape(shape)
+
+    def expand(self, packed):
+        """Return full Hermitian correlation matrices from the output of pack"""
+        packed = packed.reshape((-1,self.index.size))
+        full = np.empty(shape=(packed.shape[0],self.block_size), dtype=packed.dtype)
+        full[:,self.conj_index] = packed.conj()
+        full[:,self.index] = packed
+        n_inputs = self.n_ant * self.n_pol
+        return full.reshape((-1,n_inputs,n_inputs,self.n_channel))
+
+    def uvw(self, uvw0):
+        """Return baseline UVWs (block * baseline * 3) from antenna UVWs (block * antenna * 3)"""
+        return uvw0[:,self.ant1,:] - uvw0[:,self.ant2,:]
+
+
+_plans = {}
+
+def packing_plan(n_ant, n_pol, n_channel):
+    """Return the cached PackingPlan for the given dimensions, creating it if needed"""
+    key = (n_ant, n_pol, n_channel)
+    if key not in _plans:
+        _plans[key] = PackingPlan(n_ant, n_pol, n_channel)
+    return _plans[key]
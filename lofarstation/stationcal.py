@@ -1,41 +1,75 @@
 #!/usr/bin/env python
 
 import numpy as np
+from collections import OrderedDict
+import os.path
 
 DEFAULT_N_RCU = 192
 DEFAULT_N_FREQ = 512
+CACHE_SIZE = 16 # CalTables kept by stationcal.cached
+
+# (path, mtime, n_freq, n_rcu): stationcal, least recently used first
+_cache = OrderedDict()
 
 class stationcal(object):
-    def __init__(self, filename, n_freq=DEFAULT_N_FREQ, n_rcu=DEFAULT_N_RCU):
-	self.n_freq = n_freq
-	self.n_rcu = n_rcu
-        with open(filename) as self._inf:
+    """A Lofar station CalTable. The gains (n_freq * n_rcu) are memory mapped, unless
+    mmap is False, so only the parts that are used are read."""
+    def __init__(self, filename, n_freq=DEFAULT_N_FREQ, n_rcu=DEFAULT_N_RCU, mmap=True):
+        self.n_freq = n_freq
+        self.n_rcu = n_rcu
+        with open(filename, "rb") as self._inf:
             self.header = self._read_header()
-            self.cal_data = self._read_cal_data()
+            offset = self._inf.tell()
+            if mmap:
+                self.cal_data = np.memmap(filename, dtype=np.complex128, mode="r", offset=offset,
+                                          shape=(self.n_freq,self.n_rcu))
+            else:
+                self.cal_data = self._read_cal_data()
+        del self._inf
+        self.header_values = self._parse_header(self.header)
+
+    @classmethod
+    def cached(cls, filename, n_freq=DEFAULT_N_FREQ, n_rcu=DEFAULT_N_RCU):
+        """Return the stationcal of filename, reusing the one loaded earlier in this process
+        unless the file has changed since. The returned tables are shared, do not modify them."""
+        path = os.path.abspath(filename)
+        key = (path, os.path.getmtime(path), n_freq, n_rcu)
+        cal = _cache.pop(key, None)
+        if cal is None:
+            cal = cls(path, n_freq, n_rcu)
+            while len(_cache) >= CACHE_SIZE:
+                _cache.popitem(last=False)
+        _cache[key] = cal
+        return cal
 
     def _read_header(self):
         header = []
-        assert self._inf.readline() == "HeaderStart\n"
+        assert self._inf.readline() == b"HeaderStart\n"
         line = self._inf.readline()
-        while line != "HeaderStop\n":
-            header.append(line)
+        while line != b"HeaderStop\n":
+            if line == b"":
+                raise ValueError("CalTable header has no HeaderStop")
+            header.append(line.decode("latin-1"))
             line = self._inf.readline()
         return header
 
+    @staticmethod
+    def _parse_header(header):
+        values = {}
+        for line in header:
+            try:
+                line_key, line_val = [s.strip() for s in line.split("=")]
+            except ValueError:
+                continue
+            values.setdefault(line_key, line_val)
+        return values
+
     def _read_cal_data(self):
         cal_data = np.fromfile(self._inf, dtype=np.complex128, count=(self.n_freq*self.n_rcu))
         return cal_data.reshape((self.n_freq,self.n_rcu))
     
     def header_val(self, key):
-        for line in self.header:
-            try:
-                line_key, line_val = [s.strip() for s in line.split("=")]
-            except ValueError:
-                continue
-            if line_key == key:
-                return line_val
-        else:
-            return ""
+        return self.header_values.get(key, "")
 
 def main():
     import matplotlib.pyplot as plt
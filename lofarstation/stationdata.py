@@ -1,21 +1,29 @@
 from casacore.measures import measures
 from casacore.quanta import quantity
-from .meas_set import MeasurementSet
+from .meas_set import MeasurementSet, incremental_columns
 from . import antfield
 import datetime
 from datetime import timedelta
 from .datetime_casacore import datetime_casacore
-from .uvw import UVW
+from .uvw import UVW, DEFAULT_REFERENCE_INTERVAL, DEFAULT_KNOT_INTERVAL
+from .packing import packing_plan
+from .instrumentation import span
 from collections import OrderedDict
 from stationcal import stationcal
 import numpy as np
 import logging
 import os.path
 import re
+import threading
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
 
 
 C = 299792458.0
 DEFAULT_STATION_NAME = "LOFAR_STATION"
+DEFAULT_CHUNK_SIZE = 64 # Blocks written to the MAIN table per putcol
 
 
 def channel_centre_frequencies(band_centre_frequency, n_channel, channel_width):
@@ -32,11 +40,21 @@ def num_baselines(n_ant, autos=False):
         return int((n_ant - 1) * n_ant / 2)
 
 
+def filename_time(datafile):
+    """Time in the name of a station data file, e.g. 20170101_120000_xst.dat, as a
+    datetime_casacore, or None if the name has none"""
+    match = re.match("^(\d{4})(\d{2})(\d{2})_(\d{2})(\d{2})(\d{2}).*$", os.path.basename(datafile))
+    if not match:
+        return None
+    return datetime_casacore(*[int(x) for x in match.groups()])
+
+
 class RCUMode(object):
     valid_modes = [3,5,6,7]
     n_subband = 512
     def __init__(self, mode):
         assert mode in self.valid_modes
+        self.mode = mode
         if mode == 3:
             self.band = "LBA"
             self.clock_frequency = 200e6
@@ -66,16 +84,26 @@ class RCUMode(object):
 class XCStationData(object):
     _n_pol = 2 # Polarisations per antenna
     _n_channel = 1 # Frequencies per sub-band
+    uvw_methods = ["exact", "fast", "interpolate"]
+    _uvw_method = "exact"
+    uvw_reference_interval = DEFAULT_REFERENCE_INTERVAL
+    uvw_knot_interval = DEFAULT_KNOT_INTERVAL
+    uvw_error = None # Interpolation error report from the last UVW calculation
+    missing = None # Per block mask, True for blocks without data that are flagged, or None
+    _packed_storage = False
     
-    def __init__(self, datafile, rcu_mode, subband, integration_time, antfile="", start_time=None, direction=None, station_name=""):
+    def __init__(self, datafile, rcu_mode, subband, integration_time, antfile="", start_time=None, direction=None, station_name="", mmap=True):
         self._datafile = datafile
+        self._mmap = mmap
         self.subband = subband
         self.integration_time = integration_time
         self.rcu_mode = RCUMode(rcu_mode)
         self._set_frequency(subband)
         self.station_name = station_name
         self._set_antenna_field(antfile)
-        self._set_raw_data(datafile)
+        with span("load") as s:
+            self._set_raw_data(datafile)
+            s.nbytes = self.raw_data.nbytes
         self._set_inital_cal()
         self._set_time(start_time)
         self._set_subband_id(subband)
@@ -85,29 +113,50 @@ class XCStationData(object):
             self.direction = direction
 
     def _start_time_from_filename(self):
-        match = re.match("^(\d{4})(\d{2})(\d{2})_(\d{2})(\d{2})(\d{2}).*$", os.path.basename(self._datafile))
-        if not match:
+        start_time = filename_time(self._datafile)
+        if start_time is None:
             raise ValueError("Start time not provided and could not deduce from file name")
         else:
-            start_time = datetime_casacore(*[int(x) for x in match.groups()])
             start_time -= timedelta(seconds=self.integration_time) # time in file name is end of first integration
             return start_time
 
+    def _capture_time_mjd(self, datafile):
+        """Block times of datafile, another capture like this one, from the time in its file
+        name and its size, without reading it. None if they can not be told that way."""
+        start, own_start = filename_time(datafile), filename_time(self._datafile)
+        if start is None or own_start is None:
+            return None
+        offset = self.time_mjd[0] - own_start.mjd_seconds()
+        n_block = self._capture_blocks(datafile)
+        return start.mjd_seconds() + offset + self.integration_time * np.arange(n_block, dtype=np.float64)
+
+    def _capture_blocks(self, datafile):
+        """Number of blocks that would be read from datafile"""
+        return os.path.getsize(datafile) // self.block_bytes
+
     def _set_time(self, start_time, offset=0):
         if start_time == None:
             start_time = self._start_time_from_filename()
-        time = []
-        t_delta = timedelta(seconds=self.integration_time)
-        t_offset = timedelta(seconds=offset) + t_delta / 2 # time values are midpoints so add half an integration
-        for i in range(self.n_block):
-            t = start_time + i * t_delta + t_offset
-            time.append(datetime_casacore.from_datetime(t))
-        self._time = time
-    
+        t0 = datetime_casacore.from_datetime(start_time).mjd_seconds()
+        t0 += offset + self.integration_time / 2.0 # time values are midpoints so add half an integration
+        self._set_time_mjd(t0 + self.integration_time * np.arange(self.n_block, dtype=np.float64))
+
+    def _set_time_mjd(self, time_mjd):
+        self._time_mjd = np.asarray(time_mjd, dtype=np.float64)
+        self._time = None
+
+    @property
+    def time_mjd(self):
+        """Block times as an array of UTC MJD seconds"""
+        return self._time_mjd
+
     @property
     def time(self):
+        """Block times as a list of datetime_casacore, generated from time_mjd when first used"""
+        if self._time is None:
+            self._time = datetime_casacore.list_from_mjd_seconds(self.time_mjd)
         return self._time
-    
+
     @property
     def frequency(self):
         return self._frequency
@@ -119,7 +168,7 @@ class XCStationData(object):
     def _set_subband_id(self, subband):
         """subband_id holds an index into the frequency array for each block"""
         if subband == -1:
-            self.subband_id = np.arange(RCUMode.n_subband, dtype=np.int32)
+            self.subband_id = np.arange(self.n_block, dtype=np.int32) # One block per subband, fewer if truncated
         else:
             self.subband_id = np.zeros(self.n_block, dtype=np.int32)
 
@@ -150,29 +199,39 @@ class XCStationData(object):
     def antenna_field(self):
         return self._antenna_field
     
+    @staticmethod
+    def _antenna_field_path(station_name):
+        """Return the path of the AntennaField conf included with this package for station_name"""
+        return antfield.station_path(station_name)
+
     def _antenna_field_from_station_name(self):
-        antfield = os.path.join(os.path.split(__file__)[0], "AntennaFields/{}-AntennaField.conf".format(self.station_name))
-        if os.path.exists(antfield):
-            return antfield
-        else:
-            raise ValueError("No AntennaField conf found for station: {}".format(self.station_name))
+        return self._antenna_field_path(self.station_name)
     
     def _set_antenna_field(self, antfile=""):
-        if antfile == "":
-            if self.station_name != "":
-                antfile = self._antenna_field_from_station_name()
-            else:
-                raise ValueError("Cannot set AntennaField, antfile or station name should be set")
-        self._antenna_field = antfield.from_file(antfile)
+        """antfile is an AntennaField.conf file name or an already parsed AntennaField (from antfield.from_file)"""
+        if isinstance(antfile, dict):
+            self._antenna_field = antfile
+            antfile = ""
+        else:
+            if antfile == "":
+                if self.station_name != "":
+                    antfile = self._antenna_field_from_station_name()
+                else:
+                    raise ValueError("Cannot set AntennaField, antfile or station name should be set")
+            self._antenna_field = antfield.cached(antfile)
         self._position = np.array(self.antenna_field[self.rcu_mode.band][0])
         antenna_offsets = np.array(self.antenna_field[self.rcu_mode.band][1])[:,0,:]
         self._antenna_positions = antenna_offsets + self.position
         if self.station_name == "":
-            station_name_match = re.match("^(?P<name>[A-Z]{2}\d{3})-AntennaField.conf$", os.path.basename(antfile))
-            if station_name_match:
-                self.station_name = station_name_match.group("name")
-            else:
-                self.station_name = DEFAULT_STATION_NAME
+            self.station_name = self._station_name_from_antfile(antfile)
+
+    @staticmethod
+    def _station_name_from_antfile(antfile):
+        station_name_match = re.match("^(?P<name>[A-Z]{2}\d{3})-AntennaField.conf$", os.path.basename(antfile))
+        if station_name_match:
+            return station_name_match.group("name")
+        else:
+            return DEFAULT_STATION_NAME
     
     @property
     def n_block(self):
@@ -205,10 +264,51 @@ class XCStationData(object):
     @property
     def n_baseline(self):
         return num_baselines(self.n_ant, autos=True)
+
+    @property
+    def packing_plan(self):
+        """The PackingPlan, shared by all data of the same dimensions, from full matrices to MS order"""
+        return packing_plan(self.n_ant, self.n_pol, self.n_channel)
     
+    @property
+    def _block_shape(self):
+        return (self.n_inputs, self.n_inputs, self.n_channel)
+
+    @property
+    def block_bytes(self):
+        """Size of one block (correlation matrix) in a raw XST/ACC file"""
+        return np.dtype(np.complex128).itemsize * int(np.prod(self._block_shape))
+
+    def _read_blocks(self, datafile, first_block=0, n_blocks=None):
+        """Return n_blocks correlation matrices starting at first_block from a raw XST/ACC file.
+        If n_blocks is None all remaining complete blocks are returned. When memory mapping
+        is enabled only the bytes of the blocks that are actually accessed are read from disk,
+        and the map is copy-on-write so raw_data stays writable without changing the file.
+        n_blocks=0 returns no data, for a file that has no complete block yet."""
+        dtype = np.dtype(np.complex128)
+        block_bytes = self.block_bytes
+        file_blocks, remainder = divmod(os.path.getsize(datafile), block_bytes)
+        if n_blocks is None:
+            if remainder != 0:
+                logging.warning("{} has {} trailing bytes that do not form a complete block".format(datafile, remainder))
+            n_blocks = file_blocks - first_block
+            if n_blocks < 1:
+                raise ValueError("No blocks from {} available in {} ({} blocks)".format(first_block, datafile, file_blocks))
+        if n_blocks < 0 or first_block + n_blocks > file_blocks:
+            raise ValueError("Blocks {}..{} not available in {} ({} blocks)".format(first_block, first_block + n_blocks - 1, datafile, file_blocks))
+        shape = (n_blocks,) + self._block_shape
+        offset = first_block * block_bytes
+        if n_blocks == 0:
+            return np.empty(shape=shape, dtype=dtype)
+        if self._mmap:
+            return np.memmap(datafile, dtype=dtype, mode="c", offset=offset, shape=shape)
+        with open(datafile, "rb") as inf:
+            inf.seek(offset)
+            raw_data = np.fromfile(inf, dtype=dtype, count=int(np.prod(shape)))
+        return raw_data.reshape(shape)
+
     def _set_raw_data(self, datafile):
-        _raw_data = np.fromfile(datafile, dtype=np.complex128)
-        self._raw_data = _raw_data.reshape((-1, self.n_inputs, self.n_inputs, self.n_channel))
+        self._raw_data = self._read_blocks(datafile)
     
     @property
     def raw_data(self):
@@ -224,6 +324,36 @@ class XCStationData(object):
         self._uvw_valid = False
         self._data_valid = False
     
+    @property
+    def uvw_method(self):
+        """How UVWs are calculated. "exact" uses casacore for every block, "fast" uses casacore
+        only at reference epochs and NumPy rotations in between (see UVW.uvw0_batch),
+        "interpolate" uses casacore every uvw_knot_interval seconds and interpolates in between
+        (see UVW.uvw0_interpolated), the error report is stored in uvw_error"""
+        return self._uvw_method
+
+    @uvw_method.setter
+    def uvw_method(self, value):
+        if value not in self.uvw_methods:
+            raise ValueError("Unknown UVW method {}, should be one of {}".format(value, self.uvw_methods))
+        self._uvw_method = value
+        self._uvw_valid = False
+        self._data_valid = False
+
+    @property
+    def packed_storage(self):
+        """If set, station_data and data are held as only the unique baselines (upper triangle,
+        autos included) per block, shape block * baseline * channel * n_pol_out, which roughly
+        halves their memory use. Calibration and packing work on this directly and data
+        returns an ExpandedData view that expands full matrices only for the blocks indexed."""
+        return self._packed_storage
+
+    @packed_storage.setter
+    def packed_storage(self, value):
+        self._packed_storage = bool(value)
+        self._station_data_valid = False
+        self._data_valid = False
+
     @property
     def position(self):
         return self._position
@@ -235,16 +365,38 @@ class XCStationData(object):
     def _set_inital_cal(self):
         self.cals = OrderedDict()
         self.cals["geo"] = np.ones(shape=(self.n_ant), dtype=np.complex128)
+        self._station_data_valid = False
     
-    def _calculate_uvw(self):
+    def _uvw_machine(self):
         uvw_machine = UVW(self.antenna_positions)
-        uvw_machine.set_direction(self.direction)
         position = measures().position("ITRF", *[quantity(x, "m") for x in self.position])
         uvw_machine.set_position(position)
-        self._uvw0 = np.empty(shape=(self.n_block,self.n_ant,3), dtype=np.float64)
-        for i,t in enumerate(self.time):
-            uvw_machine.set_time(t.epoch())
-            self._uvw0[i] = uvw_machine.uvw0
+        return uvw_machine
+
+    def _direction_uvw0(self, direction, uvw_machine=None):
+        """Return reference UVWs for every block towards direction, using uvw_method,
+        and the interpolation error report (None unless interpolating)"""
+        if uvw_machine is None:
+            uvw_machine = self._uvw_machine()
+        uvw_machine.set_direction(direction)
+        error = None
+        if self.uvw_method == "fast":
+            uvw0 = uvw_machine.uvw0_batch(self.time_mjd, self.uvw_reference_interval)
+        elif self.uvw_method == "interpolate":
+            uvw0, error = uvw_machine.uvw0_interpolated(self.time_mjd, self.uvw_knot_interval)
+            logging.info("UVW interpolation error: {max_baseline_error:.3g} m (baseline), {max_error:.3g} m (reference) "
+                         "from {n_check} checks between {n_knot} knots".format(**error))
+        else:
+            uvw0 = np.empty(shape=(self.n_block,self.n_ant,3), dtype=np.float64)
+            for i,t in enumerate(self.time_mjd):
+                uvw_machine.set_time(t)
+                uvw0[i] = uvw_machine.uvw0
+        return uvw0, error
+
+    def _calculate_uvw(self):
+        with span("uvw") as s:
+            self._uvw0, self.uvw_error = self._direction_uvw0(self.direction)
+            s.nbytes = self._uvw0.nbytes
         self._uvw_valid = True
         self._data_valid = False
     
@@ -258,86 +410,289 @@ class XCStationData(object):
     def uvw(self):
         return np.expand_dims(self.uvw0, 2) - np.expand_dims(self.uvw0, 1)
     
-    def packed_uvw(self):
-        a1, a2 = np.triu_indices(self.n_ant)
-        return self.uvw[:,a1,a2,:].reshape((-1,3))
+    def packed_uvw(self, start=0, stop=None):
+        """Baseline UVWs for blocks start..stop in MS row order"""
+        return self.packing_plan.uvw(self.uvw0[start:stop]).reshape((-1,3))
     
     @staticmethod
     def complex_phase(omega):
         return np.exp(-2j * np.pi * omega)
     
-    def _delay_to_phase(self, delays):
+    def _delay_to_phase(self, delays, start=0, stop=None):
+        """Phases for delays of blocks start..stop"""
         # Want n_block * n_input * n_channel
         if delays.shape[-1] == self.n_ant:
             # One value for antenna, repeat for 2 pols
             delays = delays.repeat(2, axis=-1)[:,:,np.newaxis] # shape is n_block * n_inputs * 1
-        freqs = self.frequency[self.subband_id][:,np.newaxis,:]  # shape is n_block * 1 * n_channel
+        freqs = self.frequency[self.subband_id[start:stop]][:,np.newaxis,:]  # shape is n_block * 1 * n_channel
         wraps = delays * freqs # shape is n_block * n_input * n_channel
         phase = self.complex_phase(wraps)
         return phase
 
     def set_station_cal(self, calfile):
-        gains = stationcal(calfile).cal_data
+        """calfile is a CalTable file name or an already loaded stationcal.
+        Tables loaded by name are cached, so calibrating many files with one table reads it once."""
+        if not isinstance(calfile, stationcal):
+            calfile = stationcal.cached(calfile)
+        gains = calfile.cal_data
         freqs, inputs = gains.shape
         assert inputs == self.n_inputs or inputs == 1
         if self.subband >= 0:
             gains = gains[np.newaxis,self.subband,:]
         self.cals["station"] = gains[:,:,np.newaxis]
+        self._station_data_valid = False
         self._data_valid = False
     
-    def _calculate_data(self):
-        self.cals["geo"] = self._delay_to_phase(self.uvw0[...,2] / C)
-        self._data = self.raw_data
+    def _geo_cal(self, start=0, stop=None):
+        """Geometric phases of blocks start..stop, shape block * input * channel"""
+        return self._delay_to_phase(self.uvw0[start:stop,:,2] / C, start, stop)
+
+    def _set_geo_cal(self):
+        self.cals["geo"] = self._geo_cal()
+
+    @staticmethod
+    def _block_cal(cal, start, stop):
+        """Return the part of cal that applies to blocks start..stop. Single entry cals apply to all blocks."""
+        if cal.shape[0] == 1:
+            return cal
+        return cal[start:stop]
+
+    def _combined_gains(self, start, stop, exclude=[]):
+        """Return the product of all cals, except those named in exclude, for blocks start..stop.
+        Shape is (n_block or 1) * n_inputs * (n_channel or 1), None if there are no cals."""
+        gains = None
         for name, cal in self.cals.items():
-            self._data = cal[:,:,np.newaxis,:] * self._data * cal[:,np.newaxis,:,:].conj()
+            if name in exclude:
+                continue
+            cal = self._block_cal(cal, start, stop)
+            gains = cal if gains is None else gains * cal
+        return gains
+
+    @staticmethod
+    def apply_gains(data, gains, out=None):
+        """Return gains_i * data_ij * conj(gains_j) for data of shape block * input * input * channel
+        and gains of shape block * input * channel. The result is written to out if given, which
+        may be data itself to calibrate in place."""
+        if out is None:
+            shape = np.broadcast(data, gains[:,:,np.newaxis,:]).shape
+            out = np.empty(shape, dtype=np.result_type(data, gains))
+        np.multiply(data, gains[:,:,np.newaxis,:], out=out)
+        np.multiply(out, gains[:,np.newaxis,:,:].conj(), out=out)
+        return out
+
+    def _pack_blocks(self, data, out=None):
+        """Return the unique baselines of full correlation matrices (block * input * input * channel),
+        shape block * baseline * channel * n_pol_out"""
+        return self.packing_plan.pack(data, out)
+
+    def _expand_blocks(self, packed):
+        """Return full Hermitian correlation matrices from the output of _pack_blocks"""
+        return self.packing_plan.expand(packed)
+
+    def _apply_packed_gains(self, packed, gains, out=None):
+        """apply_gains for data from _pack_blocks"""
+        a1, a2 = self.packing_plan.ant1, self.packing_plan.ant2
+        shape = (-1,len(a1),self.n_channel,self.n_pol,self.n_pol)
+        if out is None:
+            out = np.empty(shape=packed.shape, dtype=np.result_type(packed, gains))
+        # block, antenna, channel, pol
+        gains = gains.reshape((gains.shape[0],self.n_ant,self.n_pol,-1)).swapaxes(2, 3)
+        for start in range(0, packed.shape[0], DEFAULT_CHUNK_SIZE):
+            stop = start + DEFAULT_CHUNK_SIZE
+            g = self._block_cal(gains, start, stop)
+            o = out[start:stop].reshape(shape)
+            np.multiply(packed[start:stop].reshape(shape), g[:,a1,:,:,np.newaxis], out=o)
+            np.multiply(o, g[:,a2,:,np.newaxis,:].conj(), out=o)
+        return out
+
+    def _apply(self, data, gains, out=None):
+        """apply_gains for data in the current storage layout"""
+        if self.packed_storage:
+            return self._apply_packed_gains(data, gains, out)
+        return self.apply_gains(data, gains, out)
+
+    def _raw_blocks(self, start, stop):
+        """Raw data for blocks start..stop in the current storage layout"""
+        if self.packed_storage:
+            return self._pack_blocks(self.raw_data[start:stop])
+        return self.raw_data[start:stop]
+
+    @property
+    def station_data(self):
+        """Raw data with the direction independent cals (all but geo, e.g. the station cal)
+        applied. This is cached so a change of direction only needs the geometric phase
+        to be applied. It is the raw data itself if there are no such cals.
+        Call set_station_cal, rather than modifying cals directly, to keep it up to date."""
+        if not self._station_data_valid:
+            with span("station_cal") as s:
+                gains = self._combined_gains(0, self.n_block, exclude=["geo"])
+                self._station_data = self._raw_blocks(0, self.n_block)
+                if gains is not None:
+                    out = self._station_data if self.packed_storage else None
+                    self._station_data = self._apply(self._station_data, gains, out)
+                s.nbytes = self._station_data.nbytes
+            self._station_data_valid = True
+        return self._station_data
+
+    def _calibrated_blocks(self, start, stop, out=None):
+        """Return calibrated data for blocks start..stop without calculating the full data array.
+        Only the geometric phases of these blocks are calculated."""
+        if self._data_valid:
+            return self._data[start:stop]
+        geo = self._geo_cal(start, stop)
+        if self._station_data_valid:
+            return self._apply(self._station_data[start:stop], geo, out)
+        gains = self._combined_gains(start, stop, exclude=["geo"])
+        return self._apply(self._raw_blocks(start, stop), geo if gains is None else gains * geo, out)
+
+    def calculate_data(self, out=None):
+        """Calculate the calibrated data and return it. Only the geometric phase is applied
+        to the cached station_data, so after a change of direction the station cal is not
+        applied again. If out is given the result is written there, for example the current
+        data array to reuse its memory after a change of direction."""
+        with span("calculate_data") as s:
+            self._set_geo_cal()
+            self._data = self._apply(self.station_data, self.cals["geo"], out)
+            s.nbytes = self._data.nbytes
         self._data_valid = True
+        return self._data
 
     @property
     def data(self):
         if not self._data_valid:
-            self._calculate_data()
+            self.calculate_data()
+        if self.packed_storage:
+            return ExpandedData(self)
         return self._data
     
-    def packed_data(self):
-        a1, a2 = np.triu_indices(self.n_ant)
-        # Reorder to block, dummy, ant1, pol1, ant2, pol2, channel
-        data = self.data.reshape((-1,1,self.n_ant,self.n_pol,self.n_ant,self.n_pol,self.n_channel))
-        data = data[:,:,a1,:,a2,:,:] # baseline, block, dummy, pol, pol, channel
-        data = data.swapaxes(0, 1) # baseline <-> block
-        data = data.swapaxes(2, -1) # dummy <-> channel
-        data = data.reshape((-1,self.n_channel,self.n_pol_out)) # merge block & baseline, pols
-        return data
+    def beam_power(self, directions, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Return the beamformed power w^H R w towards each of directions for every block and
+        channel, shape n_direction * n_block * n_channel. R are the raw correlation matrices
+        and w the geometric phases, combined with the direction independent cals (e.g. the
+        station cal), normalised so the result equals data.mean over both input axes with
+        direction set. All directions are evaluated together with matrix products, chunk_size
+        blocks at a time, without calculating data for any of them."""
+        uvw_machine = self._uvw_machine()
+        weights = [self._delay_to_phase(self._direction_uvw0(d, uvw_machine)[0][...,2] / C) for d in directions]
+        weights = np.array(weights) # direction, block, input, channel
+        gains = self._combined_gains(0, self.n_block, exclude=["geo"])
+        if gains is not None:
+            weights = weights * gains
+        # Arrange weights as block, channel, input, direction to match the moved data axes
+        weights = weights.transpose((1, 3, 2, 0))
+        if chunk_size is None or chunk_size < 1:
+            chunk_size = self.n_block
+        power = np.empty(shape=(self.n_block, self.n_channel, len(directions)), dtype=np.float64)
+        with span("beam_power") as s:
+            for start in range(0, self.n_block, chunk_size):
+                stop = min(start + chunk_size, self.n_block)
+                acm = np.moveaxis(self.raw_data[start:stop], -1, 1) # block, channel, input, input
+                w = weights[start:stop] if weights.shape[0] > 1 else weights
+                power[start:stop] = (w * np.matmul(acm, w.conj())).sum(axis=2).real
+            s.nbytes = self.raw_data.nbytes
+        return power.transpose((2, 0, 1)) / self.n_inputs**2
+
+    def packed_data(self, start=0, stop=None, out=None):
+        """Data for blocks start..stop in MS row order. Only the requested blocks are
+        calibrated unless the full data array has already been calculated. If out is given
+        the result is written to it, it should have the shape of the result."""
+        with span("packed_data") as s:
+            if start == 0 and stop is None:
+                if not self._data_valid:
+                    self.calculate_data()
+                data = self._data
+            else:
+                data = self._calibrated_blocks(start, stop)
+            if not self.packed_storage:
+                data = self._pack_blocks(data, out)
+            elif out is not None:
+                out[...] = data.reshape(out.shape)
+                data = out
+            s.nbytes = data.nbytes
+        return data.reshape((-1,self.n_channel,self.n_pol_out)) # merge block & baseline
     
-    def write_ms(self, ms_name, station_name=""):
-        """Write out Measurement Set"""
-        logging.info("Creating Measurement Set")
-        ms = MeasurementSet(ms_name)
+    def write_ms(self, ms_name, station_name="", chunk_size=DEFAULT_CHUNK_SIZE, layout="default"):
+        """Write out Measurement Set.
+        The MAIN table is written chunk_size blocks at a time so peak memory depends on
+        the chunk size rather than the number of blocks. chunk_size=None writes all at once.
+        layout is the storage layout profile of the MAIN table, see meas_set.storage_layouts."""
+        with span("write_ms"):
+            logging.info("Creating Measurement Set")
+            ms = self._create_ms(ms_name, layout)
+            logging.info("Populating MAIN Table")
+            time_range = self._append_main(ms, chunk_size)
+            with span("subtables"):
+                self._write_subtables(ms, station_name, time_range)
+            ms.flush()
 
-        if station_name == "":
-            station_name = self.station_name
+    def _create_ms(self, ms_name, layout="default"):
+        return MeasurementSet(ms_name, layout, (self.n_channel, self.n_pol_out), self.n_baseline)
 
-        # MAIN table
-        logging.info("Populating MAIN Table")
+    def _append_main(self, ms, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Append rows for all blocks to the MAIN table of ms, chunk_size blocks at a time.
+        Returns the first and last time written."""
+        startrow0 = ms.main.nrows()
         n_rows = self.n_block * self.n_baseline
         ms.main.addrows(n_rows)
-        ant1, ant2 = np.triu_indices(self.n_ant)
-        ms.main.putcol("ANTENNA1", np.tile(ant1, self.n_block))
-        ms.main.putcol("ANTENNA2", np.tile(ant2, self.n_block))
-        ms.main.putcol("WEIGHT", np.ones(shape=(n_rows, self.n_pol_out), dtype=np.float64))
-        ms.main.putcol("SIGMA", np.ones(shape=(n_rows, self.n_pol_out), dtype=np.float64))
-        ms.main.putcol("INTERVAL", np.full((n_rows,), self.integration_time, dtype=np.float64))
-        ms.main.putcol("EXPOSURE", np.full((n_rows,), self.integration_time, dtype=np.float64))
-        time_mjd = np.array([t.mjd_seconds() for t in self.time])
-        ms.main.putcol("TIME", np.repeat(time_mjd, self.n_baseline))
-        ms.main.putcol("TIME_CENTROID", np.repeat(time_mjd, self.n_baseline))
-        ms.main.putcol("DATA_DESC_ID", np.repeat(self.subband_id, self.n_baseline))
-        data = self.packed_data()
-        ms.main.putcol("DATA", data)
-        ms.main.putcol("FLAG", np.zeros(shape=data.shape, dtype="bool"))
-        ms.main.putcol("UVW", self.packed_uvw())
+        incremental = incremental_columns(ms.main)
+        ant1, ant2 = self.packing_plan.ant1, self.packing_plan.ant2
+        time_mjd = self.time_mjd
+        if chunk_size is None or chunk_size < 1:
+            chunk_size = self.n_block
+        self.uvw0 # Make sure UVWs are current before chunking
+        for start in range(0, self.n_block, chunk_size):
+            stop = min(start + chunk_size, self.n_block)
+            n_chunk = stop - start
+            startrow = startrow0 + start * self.n_baseline
+            nrow = n_chunk * self.n_baseline
+            logging.debug("Writing blocks {}..{} of {}".format(start, stop - 1, self.n_block))
+            data = self.packed_data(start, stop)
+            uvw = self.packed_uvw(start, stop)
+            block_values = [("WEIGHT", np.ones(shape=(n_chunk, self.n_pol_out), dtype=np.float64)),
+                            ("SIGMA", np.ones(shape=(n_chunk, self.n_pol_out), dtype=np.float64)),
+                            ("INTERVAL", np.full((n_chunk,), self.integration_time, dtype=np.float64)),
+                            ("EXPOSURE", np.full((n_chunk,), self.integration_time, dtype=np.float64)),
+                            ("TIME", time_mjd[start:stop]),
+                            ("TIME_CENTROID", time_mjd[start:stop]),
+                            ("DATA_DESC_ID", self.subband_id[start:stop]),
+                            ("FLAG", self._block_flags(start, stop))]
+            with span("putcol") as s:
+                ms.main.putcol("ANTENNA1", np.tile(ant1, n_chunk), startrow, nrow)
+                ms.main.putcol("ANTENNA2", np.tile(ant2, n_chunk), startrow, nrow)
+                for column, values in block_values:
+                    self._put_block_values(ms.main, column, values, startrow, self.n_baseline, column in incremental)
+                ms.main.putcol("DATA", data, startrow, nrow)
+                ms.main.putcol("UVW", uvw, startrow, nrow)
+                s.nbytes = data.nbytes + uvw.nbytes # The bulk of the rows
+            del data
+        return time_mjd[0], time_mjd[-1]
+
+    def _block_flags(self, start, stop):
+        """FLAG values of blocks start to stop, all set for missing blocks"""
+        flags = np.zeros(shape=(stop - start, self.n_channel, self.n_pol_out), dtype="bool")
+        if self.missing is not None:
+            flags[self.missing[start:stop]] = True
+        return flags
+
+    @staticmethod
+    def _put_block_values(tab, column, values, startrow, n_baseline, incremental=False):
+        """Write values, one per block, to all n_baseline rows of consecutive blocks from startrow.
+        For an incrementally stored column only the rows where the value changes are written."""
+        if incremental:
+            for i, value in enumerate(values):
+                if i == 0 or not np.array_equal(value, values[i-1]):
+                    tab.putcell(column, startrow + i * n_baseline, value)
+        else:
+            tab.putcol(column, np.repeat(values, n_baseline, axis=0), startrow, len(values) * n_baseline)
+
+    def _write_subtables(self, ms, station_name, time_range):
+        """Write the MAIN table keywords and the sub tables. time_range is the first and last
+        time in the MAIN table."""
+        if station_name == "":
+            station_name = self.station_name
+        time_first, time_last = time_range
         ms.main.putcolkeyword("UVW", "QuantumUnits", ["m","m","m"])
         ms.main.putcolkeyword("UVW", "MEASINFO", {"Ref": "J2000", "type": "uvw"})
-     
 
         # ANTENNA table
         logging.info("Populating ANTENNA Table")
@@ -352,7 +707,7 @@ class XCStationData(object):
         ms.feed[:] = {"BEAM_OFFSET": np.zeros(shape=(2,2)), "POLARIZATION_TYPE": np.array(["X","Y"]),
                       "POL_RESPONSE": np.identity(2, dtype="complex64"),
                       "RECEPTOR_ANGLE": np.zeros(shape=(2,)), "BEAM_ID": -1, "FEED_ID": 0,
-                      "INTERVAL": 0, "NUM_RECEPTORS": 2, "SPECTRAL_WINDOW_ID": -1, "TIME": time_mjd[0]}
+                      "INTERVAL": 0, "NUM_RECEPTORS": 2, "SPECTRAL_WINDOW_ID": -1, "TIME": time_first}
         ms.feed.putcol("ANTENNA_ID", np.arange(self.n_ant))
         
         # SPECTRAL_WINDOW table
@@ -372,7 +727,7 @@ class XCStationData(object):
         logging.info("Populating OBSERVATION Table")
         ms.observation.addrows(1)
         ms.observation[0] = {"TELESCOPE_NAME": station_name, "OBSERVER": "Default",
-                             "RELEASE_DATE": time_mjd[0], "TIME_RANGE": np.array([time_mjd[0], time_mjd[-1]]),
+                             "RELEASE_DATE": time_first, "TIME_RANGE": np.array([time_first, time_last]),
                              "PROJECT": "Default", "SCHEDULE_TYPE": "", "FLAG_ROW": False}
         
         # POLARIZATION table
@@ -385,7 +740,7 @@ class XCStationData(object):
         logging.info("Populating FIELD Table")
         ms.field[0] = {"DELAY_DIR": np.array([[0.0,np.pi/2]]), "REFERENCE_DIR": np.array([[0.0,np.pi/2]]),
                        "PHASE_DIR": np.array([[self.direction["m0"]["value"], self.direction["m1"]["value"]]]),
-                       "NAME": "Field0", "SOURCE_ID": -1, "TIME": time_mjd[0]}
+                       "NAME": "Field0", "SOURCE_ID": -1, "TIME": time_first}
         ms.field.putcolkeyword("PHASE_DIR", "QuantumUnits", [self.direction["m0"]["unit"], self.direction["m1"]["unit"]])
         ms.field.putcolkeyword("PHASE_DIR", "MEASINFO", {"Ref": self.direction["refer"], "type": self.direction["type"]})
         ms.field.putcolkeyword("DELAY_DIR", "QuantumUnits", ["rad", "rad"])
@@ -393,21 +748,238 @@ class XCStationData(object):
         ms.field.putcolkeyword("REFERENCE_DIR", "QuantumUnits", ["rad", "rad"])
         ms.field.putcolkeyword("REFERENCE_DIR", "MEASINFO", {"Ref": "AZELGEO", "type": "direction"})
 
+    def write_hdf5(self, filename, chunk_size=DEFAULT_CHUNK_SIZE, compression="gzip", compression_opts=None):
+        """Write the calibrated visibilities, UVWs and metadata to an HDF5 file, for consumers that
+        want plain arrays rather than a Measurement Set. Datasets:
+          data         block * baseline * channel * correlation, complex64, MS baseline and correlation order
+          uvw          block * baseline * 3, baseline UVWs (m)
+          uvw0         block * antenna * 3, reference antenna UVWs (m)
+          antenna1/2   baseline, antenna indices of each baseline
+          time         block, block midpoints in UTC MJD seconds
+          subband_id   block, row of frequency and bandwidth for each block
+          frequency    subband * channel, channel centre frequencies (Hz), and bandwidth
+          antenna_positions  antenna * 3, ITRF (m), and position, the station reference position
+        The station name, RCU mode, integration time, correlation names and direction are attributes.
+        data, uvw and uvw0 are chunked by block and compressed with compression (any h5py filter,
+        None to disable). They are written chunk_size blocks at a time, like write_ms, and can be
+        read back lazily by slicing the h5py datasets. Requires h5py."""
+        try:
+            import h5py
+        except ImportError:
+            raise ImportError("h5py is required to write HDF5 files")
+        if chunk_size is None or chunk_size < 1:
+            chunk_size = self.n_block
+        plan = self.packing_plan
+        self.uvw0 # Make sure UVWs are current before chunking
+        filters = {"compression": compression, "compression_opts": compression_opts, "shuffle": compression is not None}
+        with h5py.File(filename, "w") as f:
+            f.attrs["station_name"] = self.station_name
+            f.attrs["rcu_mode"] = self.rcu_mode.mode
+            f.attrs["integration_time"] = self.integration_time
+            f.attrs["correlations"] = ["XX", "XY", "YX", "YY"][:self.n_pol_out]
+            f.attrs["direction_refer"] = self.direction["refer"]
+            f.attrs["direction"] = [quantity(self.direction[m]).get_value("rad") for m in ("m0", "m1")]
+            f["time"] = self.time_mjd
+            f["subband_id"] = self.subband_id
+            f["frequency"] = self.frequency
+            f["bandwidth"] = self.bandwidth
+            f["antenna1"] = plan.ant1
+            f["antenna2"] = plan.ant2
+            f["antenna_positions"] = self.antenna_positions
+            f["position"] = self.position
+            data = f.create_dataset("data", shape=(self.n_block, self.n_baseline, self.n_channel, self.n_pol_out),
+                                    dtype=np.complex64, chunks=(1, self.n_baseline, self.n_channel, self.n_pol_out), **filters)
+            uvw = f.create_dataset("uvw", shape=(self.n_block, self.n_baseline, 3), dtype=np.float64,
+                                   chunks=(1, self.n_baseline, 3), **filters)
+            f.create_dataset("uvw0", data=self.uvw0, chunks=(1, self.n_ant, 3), **filters)
+            for start in range(0, self.n_block, chunk_size):
+                stop = min(start + chunk_size, self.n_block)
+                logging.debug("Writing blocks {}..{} of {}".format(start, stop - 1, self.n_block))
+                chunk = self.packed_data(start, stop)
+                with span("write_hdf5") as s:
+                    data[start:stop] = chunk.reshape((stop - start,) + data.shape[1:])
+                    uvw[start:stop] = plan.uvw(self.uvw0[start:stop])
+                    s.nbytes = chunk.nbytes
+
+
+class ExpandedData(object):
+    """Read only view of packed_storage data as full correlation matrices,
+    shape block * input * input * channel. Only the blocks indexed are expanded,
+    np.asarray expands all of them."""
+    def __init__(self, station_data):
+        self._station_data = station_data
+        self._packed = station_data._data
+
+    @property
+    def shape(self):
+        sd = self._station_data
+        return (self._packed.shape[0], sd.n_inputs, sd.n_inputs, sd.n_channel)
+
+    @property
+    def dtype(self):
+        return self._packed.dtype
+
+    @property
+    def ndim(self):
+        return 4
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _normalise_key(self, key):
+        """Return key as a tuple with the Ellipsis expanded to slices, so the first
+        entry always indexes blocks. New axes are not supported."""
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is None for k in key):
+            raise IndexError("np.newaxis is not supported when indexing packed data")
+        ellipsis = [i for i, k in enumerate(key) if k is Ellipsis]
+        if len(ellipsis) > 1:
+            raise IndexError("an index can only have a single ellipsis ('...')")
+        if ellipsis:
+            i = ellipsis[0]
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + key[i+1:]
+        if len(key) > self.ndim:
+            raise IndexError("too many indices for packed data: {} given for {} dimensions".format(len(key), self.ndim))
+        if len(key) == 0:
+            key = (slice(None),)
+        return key
+
+    def __getitem__(self, key):
+        key = self._normalise_key(key)
+        blocks = np.arange(len(self))[key[0]]
+        if isinstance(key[0], slice) or np.ndim(blocks) == 0:
+            full = self._station_data._expand_blocks(self._packed[np.atleast_1d(blocks)])
+            if np.ndim(blocks) == 0:
+                return full[0][key[1:]]
+            return full[(slice(None),) + key[1:]]
+        # Integer array or mask: expand each selected block once, then index those with the
+        # original key so the block index broadcasts with any other index arrays
+        selected, inverse = np.unique(blocks, return_inverse=True)
+        full = self._station_data._expand_blocks(self._packed[selected])
+        return full[(inverse.reshape(blocks.shape),) + key[1:]]
+
+    def __array__(self, dtype=None, copy=None):
+        full = self[:]
+        return full if dtype is None else full.astype(dtype)
+
+
+def _concat_setup(station_data):
+    """What the inputs of write_concat_ms must have in common"""
+    return (station_data.station_name, station_data.n_ant, station_data.n_channel,
+            station_data.frequency.copy(), station_data.antenna_positions.copy(), station_data.direction)
+
+
+def _same_setup(setup, other):
+    return all(np.array_equal(a, b) if isinstance(a, np.ndarray) else a == b for a, b in zip(setup, other))
+
+
+def _concat_gap(time_mjd, integration_time, previous_time_mjd, previous_integration_time, name, previous_name):
+    """Seconds between the end of the previous input of write_concat_ms and the start of the
+    next one, raising ValueError if they overlap"""
+    if len(time_mjd) == 0:
+        raise ValueError("{} has no complete block".format(name))
+    gap = time_mjd[0] - previous_time_mjd[-1]
+    if gap < (integration_time + previous_integration_time) / 2:
+        raise ValueError("{} overlaps in time with {}".format(name, previous_name))
+    return gap - previous_integration_time
+
+
+def write_concat_ms(inputs, ms_name, station_name="", chunk_size=DEFAULT_CHUNK_SIZE, layout="default", load=None):
+    """Write consecutive captures of the same station, mode and subband, e.g. XST files, to a
+    single Measurement Set in time order. inputs are file names that load(file name) opens
+    as XCStationData, or XCStationData if load is None. File names are ordered and checked
+    for overlaps up front from the time in each name and the file size, and each file is
+    only opened while its rows are appended. Rows are appended in chunks, so only one chunk
+    of one input is calibrated at a time. Gaps between inputs are kept as gaps in TIME,
+    overlapping inputs are an error."""
+    if len(inputs) == 0:
+        raise ValueError("No station data to write")
+    if load is None:
+        inputs = sorted(inputs, key=lambda sd: sd.time_mjd[0])
+        first = inputs[0]
+        planned = [(sd.time_mjd, sd.integration_time) for sd in inputs]
+        load = lambda sd: sd
+        names = [sd._datafile for sd in inputs]
+    else:
+        if len(inputs) > 1:
+            starts = [filename_time(datafile) for datafile in inputs]
+            for datafile, start in zip(inputs, starts):
+                if start is None:
+                    raise ValueError("{} has no time in its name to order the inputs by".format(datafile))
+            inputs = [datafile for _, datafile in sorted(zip([start.mjd_seconds() for start in starts], inputs))]
+        first = load(inputs[0])
+        planned = [(first.time_mjd, first.integration_time)] + \
+                  [(first._capture_time_mjd(datafile), first.integration_time) for datafile in inputs[1:]]
+        names = list(inputs)
+    for i in range(1, len(inputs)):
+        (time_mjd, integration_time), (previous_time_mjd, previous_integration_time) = planned[i], planned[i-1]
+        if time_mjd is not None and previous_time_mjd is not None:
+            _concat_gap(time_mjd, integration_time, previous_time_mjd, previous_integration_time, names[i], names[i-1])
+    setup = _concat_setup(first)
+
+    with span("write_ms"):
+        logging.info("Creating Measurement Set")
+        ms = first._create_ms(ms_name, layout)
+        logging.info("Populating MAIN Table")
+        time_range = None
+        previous = None
+        for i, name in enumerate(names):
+            sd = first if i == 0 else load(inputs[i])
+            first = None
+            if i > 0:
+                if not _same_setup(_concat_setup(sd), setup):
+                    raise ValueError("{} does not match the station, mode, subband or direction of {}".format(name, names[0]))
+                gap = _concat_gap(sd.time_mjd, sd.integration_time, previous[0], previous[1], name, names[i-1])
+                if gap > previous[1] / 2:
+                    logging.info("Gap of {:g} seconds before {}".format(gap, name))
+            logging.info("Appending {} blocks from {}".format(sd.n_block, name))
+            time_first, time_last = sd._append_main(ms, chunk_size)
+            if time_range is None:
+                # Sub tables from the first input, the end of TIME_RANGE is set once all rows are written
+                time_range = [time_first, time_last]
+                with span("subtables"):
+                    sd._write_subtables(ms, station_name, time_range)
+            time_range[1] = time_last
+            # Only the block times are kept, so the input can be closed
+            previous = (sd.time_mjd, sd.integration_time)
+            del sd
+        ms.observation.putcell("TIME_RANGE", 0, np.array(time_range))
+        ms.flush()
+
 
 class XSTData(XCStationData):
-    pass
+    def __init__(self, datafile, rcu_mode, subband, integration_time, antfile="", start_time=None, direction=None, station_name="", mmap=True,
+                 first_block=0, n_blocks=None):
+        """first_block and n_blocks select part of the capture, for example the new blocks of a file
+        that is still being written (see follow). Block times are those of the whole capture."""
+        self._first_block = first_block
+        self._n_blocks = n_blocks
+        super(XSTData, self).__init__(datafile, rcu_mode, subband, integration_time, antfile, start_time, direction, station_name, mmap)
+
+    def _set_raw_data(self, datafile):
+        self._raw_data = self._read_blocks(datafile, self._first_block, self._n_blocks)
+
+    def _set_time(self, start_time):
+        super(XSTData, self)._set_time(start_time, offset=self._first_block * self.integration_time)
 
 
 class ACCData(XCStationData):
-    def __init__(self, datafile, rcu_mode, subband=-1, antfile="", start_time=None, direction=None, station_name=""):
-        super(ACCData, self).__init__(datafile, rcu_mode, subband, 1.0, antfile, start_time, direction, station_name)
+    def __init__(self, datafile, rcu_mode, subband=-1, antfile="", start_time=None, direction=None, station_name="", mmap=True):
+        super(ACCData, self).__init__(datafile, rcu_mode, subband, 1.0, antfile, start_time, direction, station_name, mmap)
     
     def _set_raw_data(self, datafile):
-        super(ACCData, self)._set_raw_data(datafile)
         if self.subband >= 0:
-            # Single subband (integration) selected
-            self._raw_data = self._raw_data[np.newaxis,self.subband]
+            # Single subband (integration) selected, only read that block
+            self._raw_data = self._read_blocks(datafile, self.subband, 1)
+        else:
+            super(ACCData, self)._set_raw_data(datafile)
     
+    def _capture_blocks(self, datafile):
+        if self.subband >= 0:
+            return 1
+        return super(ACCData, self)._capture_blocks(datafile)
+
     # TODO: Confirm that ACC file name is end time
     def _set_time(self, start_time):
         if self.subband >= 0:
@@ -418,7 +990,9 @@ class ACCData(XCStationData):
 class AARTFAACData (XCStationData):
     vis     = None # TransitVis object reference
     trilind = None
-    acm     = None # Temporary store of a single ACM.
+    fill_index = None # Flat indices of the upper and lower triangle matrix elements of a record
+    batch_bytes = 64 * 1024 * 1024 # Visibilities read and filled at a time
+    prefetch_depth = 3 # Records read ahead by the reader thread
 
     def __init__(self, datafile, rcu_mode, subband=-1, nchan=63,antfile="", \
                 start_time=None, direction=None, station_name=""):
@@ -449,66 +1023,189 @@ class AARTFAACData (XCStationData):
         if self.trilind is None:
             self.trilind = np.tril_indices (self.n_ant)
 
-        if self.acm is None:
-            self.acm = np.zeros ( (self.n_ant, self.n_ant), dtype=np.complex64)
-
 
     # NOTE: We misappropriate the datafile parameter to pass the TransitVis
     # object. The superclass constructor assigns the datafile parameter to 
     # the passed TransitVis, so we reassign the data filename here.
     def _set_raw_data (self, datafile):
-        ind = 0
         self.datafile = datafile.fname
-        print '<-- Writing out ', datafile.nrec, 'records to MS.'
-        self._raw_data = np.zeros ( (datafile.nrec, self.n_ant, self.n_pol, \
+        logging.info ('Reading {} records'.format (datafile.nrec))
+        raw_data = np.zeros ( (datafile.nrec, self.n_ant, self.n_pol, \
                                 self.n_ant, self.n_pol), dtype=np.complex64)
 
-        # NOTE:The time list is also populated here, making _set_time a no-op.
-        self._time = []
-
-        if self.acm is None:
-            self.acm = np.zeros ( (self.n_ant, self.n_ant), dtype=np.complex64)
-            
         if self.trilind is None:
             self.trilind = np.tril_indices (self.n_ant)
 
-        # for ind in range (0,30):
-        #     datafile.read_rec (None) # First 20 or so records are usually 0s.
+        # NOTE:The times are also populated here, making _set_time a no-op.
+        time_mjd = np.zeros (datafile.nrec, dtype=np.float64)
+
+        n_read = 0
+        for first, vis, times in self._read_batches (datafile):
+            n = len (times)
+            self._fill_hermitian (vis[:n], raw_data[first:first+n])
+            time_mjd[first:first+n] = times
+            n_read = first + n
+
+        if n_read < datafile.nrec:
+            logging.warning ('{} of {} records could not be read from {}'.format ( \
+                             datafile.nrec - n_read, datafile.nrec, self.datafile))
+        raw_data = raw_data[:n_read]
+        time_mjd = time_mjd[:n_read]
+
+        # Put the records read on the regular grid of record times, gaps become zero
+        # blocks marked in missing
+        slot, grid_mjd, self.missing = self._record_slots (datafile, time_mjd)
+        if len (slot) != len (grid_mjd) or np.any (slot != np.arange (len (slot))):
+            gridded = np.zeros ( (len (grid_mjd),) + raw_data.shape[1:], dtype=raw_data.dtype)
+            gridded[slot] = raw_data
+            raw_data = gridded
+        if self.missing.any ():
+            logging.warning ('{} of {} blocks are missing from {}'.format ( \
+                             self.missing.sum (), len (self.missing), self.datafile))
+        self._raw_data = raw_data.reshape ( (len (grid_mjd), \
+                            self.n_ant*self.n_pol, self.n_ant*self.n_pol))
+        self._set_time_mjd (grid_mjd)
+
+    @staticmethod
+    def _record_slots (datafile, time_mjd):
+        """Place records on a regular grid of record times, spaced datafile.dt from the
+        earliest record time. Returns the grid slot of each record, the grid times (the
+        record times where a record was read) and the missing mask of the grid, which
+        marks the slots without a record and the record indices listed in
+        datafile.missrec. If datafile.missrec is a count it is only compared with the
+        number of gaps."""
+        dt = datafile.dt.total_seconds ()
+        if len (time_mjd) == 0:
+            return np.zeros (0, dtype=int), time_mjd, np.zeros (0, dtype=bool)
+        slot = np.rint ( (time_mjd - time_mjd.min ()) / dt).astype (int)
+        n_slot = slot.max () + 1
+        if len (np.unique (slot)) < len (slot):
+            logging.warning ('Records with the same time in {}, only the last is kept'.format (datafile.fname))
+        grid_mjd = time_mjd.min () + dt * np.arange (n_slot)
+        grid_mjd[slot] = time_mjd
+        missing = np.ones (n_slot, dtype=bool)
+        missing[slot] = False
+        n_gap = missing.sum ()
 
-        ind = 0;
-        while ind < datafile.nrec:
+        reported = datafile.missrec
+        if np.ndim (reported) == 0:
+            if reported is not None and reported != n_gap:
+                logging.warning ('TransitVis reports {} missing records, the record times have {} gaps'.format ( \
+                                 reported, n_gap))
+        else:
+            # Record indices count from the start of the file
+            file_start = datetime_casacore.from_datetime (datafile.tfilestart).mjd_seconds ()
+            index = np.asarray (reported, dtype=int) - int (np.floor ( (time_mjd.min () - file_start) / dt))
+            missing[index[ (index >= 0) & (index < n_slot)]] = True
+        return slot, grid_mjd, missing
+
+    def _batch_size (self, n_baseline):
+        """Records per batch, so a batch of visibilities takes about batch_bytes"""
+        record_bytes = n_baseline * 2 * np.dtype (np.complex64).itemsize
+        return max (1, self.batch_bytes // record_bytes)
+
+    def _read_batches (self, datafile):
+        """Read channel averaged records from datafile, yielding the index of the first
+        record in each batch, the visibilities (batch * baseline * pol, only the
+        first n are valid) and the record times (n, MJD seconds). The visibility buffer
+        is reused for every batch. Reading stops at the first record that fails."""
+        n_baseline = len (self.trilind[0])
+        batch_size = self._batch_size (n_baseline)
+        vis = np.empty ( (batch_size, n_baseline, 2), dtype=np.complex64)
+        times = np.empty (batch_size, dtype=np.float64)
+        first = 0
+        n = 0
+        records = self._prefetch_records (datafile)
+        try:
+            for rec_vis, trec in records:
+                if datafile.nchan > 1: # Indicates a raw .vis file.
+                    vis[n] = np.mean (rec_vis, axis=1)
+                else:                  # .cal files always have nchan = 1
+                    vis[n] = rec_vis[:,0,:]
+                times[n] = datetime_casacore.from_datetime (trec).mjd_seconds()
+                n += 1
+                if n == batch_size:
+                    yield first, vis, times
+                    first += n
+                    n = 0
+            if n > 0:
+                yield first, vis, times[:n]
+        finally:
+            records.close ()
+
+    def _prefetch_records (self, datafile):
+        """Yield the visibilities and time of each record of datafile. A reader thread
+        reads up to prefetch_depth records ahead into a ring of buffers, so reading
+        overlaps with processing. The visibilities yielded are only valid until the
+        next record is requested."""
+        ring = [None] * self.prefetch_depth
+        free = Queue ()
+        full = Queue ()
+        stop = threading.Event ()
+        for slot in range (self.prefetch_depth):
+            free.put (slot)
+        reader = threading.Thread (target=self._read_records, args=(datafile, ring, free, full, stop))
+        reader.daemon = True
+        reader.start ()
+        try:
+            while True:
+                slot, trec = full.get ()
+                if slot is None:
+                    if trec is not None:
+                        logging.warning (trec)
+                    return
+                yield ring[slot], trec
+                free.put (slot)
+        finally:
+            stop.set ()
+            free.put (None)
+            reader.join ()
+
+    @staticmethod
+    def _read_records (datafile, ring, free, full, stop):
+        """Reader thread for _prefetch_records. Takes a free slot of ring, reads the next
+        record into it and passes the slot and record time on through full. Ends with
+        (None, None), or (None, message) if a record could not be read."""
+        for index in range (datafile.nrec):
+            slot = free.get ()
+            if slot is None or stop.is_set ():
+                return
             try:
                 datafile.read_rec (None)
-                if self.vis.nchan > 1: # Indicates a raw .vis file.
-                    meanacm = np.mean (datafile.vis, axis=1)
-                else:                  # .cal files always have nchan = 1
-                    meanacm = datafile.vis[:,0,:]
+                if ring[slot] is None:
+                    ring[slot] = np.empty_like (datafile.vis)
+                ring[slot][...] = datafile.vis
+            except Exception as e:
+                full.put ( (None, 'Failed to read record {}: {}'.format (index, e)))
+                return
+            full.put ( (slot, datafile.trec))
+        full.put ( (None, None))
 
-                self.acm[self.trilind] = meanacm[:,0]
-                self.acm = self.acm.transpose()
-                self.acm[self.trilind] = np.conjugate (meanacm[:,0])
-                self._raw_data [ind, :,0,:,0] = self.acm  # XX pol
-    
-                self.acm.fill(0)
+    def _fill_hermitian (self, vis, out):
+        """Fill the XX and YY correlation matrices of out (record * ant * pol * ant * pol,
+        zero initialised) from lower triangle visibilities (record * baseline * pol) for a
+        batch of records. The lower triangle, including the autos, holds the conjugate of
+        the visibilities and the upper triangle the visibilities."""
+        if self.fill_index is None:
+            # Matrix element (ant, pol, ant, pol) of each baseline and polarisation
+            row, col = self.trilind
+            pol = np.arange (2)
+            upper = ( (col[:,None]*2 + pol)*self.n_ant + row[:,None])*2 + pol
+            lower = ( (row[:,None]*2 + pol)*self.n_ant + col[:,None])*2 + pol
+            self.fill_index = (upper.ravel (), lower.ravel ())
+        upper, lower = self.fill_index
+        # Record by record, so no temporary larger than a single record is needed
+        for rec_vis, rec_out in zip (vis.reshape ( (len (vis), -1)), out.reshape ( (len (out), -1))):
+            rec_out[upper] = rec_vis
+            # Written last so the autos hold the conjugate
+            rec_out[lower] = rec_vis.conj ()
 
-                self.acm[self.trilind] = meanacm[:,1]
-                self.acm = self.acm.transpose()
-                self.acm[self.trilind] = np.conjugate (meanacm[:,1])
-                self._raw_data [ind, :,1,:,1] = self.acm  # YY pol
-    
-                self._time.append (datetime_casacore.from_datetime 
-                                                            (datafile.trec))
-    
-            except:
-                print 'Exception in reading from raw visibility file.'
-                break
-            ind = ind + 1
-        print '<-- Missing records after file read: ', datafile.missrec
-        self._raw_data = self._raw_data.reshape((datafile.nrec, \
-                            self.n_ant*self.n_pol, self.n_ant*self.n_pol))
+    def _capture_time_mjd (self, datafile):
+        # Record times are only known once the records are read
+        return None
 
     # Need to overload this function because AARTFAAC data cannot be assumed 
-    # to be strictly sequential in time, like an XST file. The time list is 
+    # to be strictly sequential in time, like an XST file. The times are 
     # already filled in the _set_raw_data () function.
     def _set_time(self, start_time, offset=0):
         return 
@@ -521,6 +1218,10 @@ class TBBXCData(XCStationData):
     def _set_raw_data(self, datafile):
         pass
 
+    def _capture_blocks(self, datafile):
+        # Blocks from the .npy header, the data is not read
+        return np.load(datafile, mmap_mode="r").shape[0]
+
     @property
     def n_channel(self):
         return self._raw_data.shape[3]
@@ -1,10 +1,74 @@
 from casacore.measures import measures, is_measure
 from casacore.quanta import quantity
 from .datetime_casacore import datetime_casacore
+from .packing import packing_plan
+from .instrumentation import span
 import datetime
 import numpy as np
 
 
+DEFAULT_REFERENCE_INTERVAL = 3600.0 # Maximum seconds between casacore reference epochs in uvw0_batch
+DEFAULT_KNOT_INTERVAL = 60.0 # Seconds between exact UVW knots in uvw0_interpolated
+INTERPOLATION_ORDER = 3 # Polynomial order used between knots
+# Directions that are fixed relative to the Earth rather than the sky
+EARTH_FIXED_DIRECTIONS = ["AZEL", "AZELSW", "AZELNE", "AZELGEO", "AZELSWGEO", "AZELNEGEO", "HADEC", "ITRF"]
+
+
+def rotation_matrices(axes, angles):
+    """Return rotation matrices (N * 3 * 3) for rotations by angles (N) about the unit vectors axes (N * 3)"""
+    axes = np.asarray(axes, dtype=np.float64)
+    angles = np.asarray(angles, dtype=np.float64)[:,np.newaxis,np.newaxis]
+    cross = np.zeros(shape=axes.shape[:-1] + (3,3))
+    cross[:,0,1], cross[:,0,2], cross[:,1,2] = -axes[:,2], axes[:,1], -axes[:,0]
+    cross -= cross.swapaxes(1, 2)
+    outer = axes[:,:,np.newaxis] * axes[:,np.newaxis,:]
+    return np.cos(angles) * np.identity(3) + np.sin(angles) * cross + (1 - np.cos(angles)) * outer
+
+
+def rotation_axis_angle(rotations):
+    """Return the unit axes (N * 3) and angles (N) of rotation matrices (N * 3 * 3)"""
+    skew = np.stack([rotations[:,2,1] - rotations[:,1,2],
+                     rotations[:,0,2] - rotations[:,2,0],
+                     rotations[:,1,0] - rotations[:,0,1]], axis=-1)
+    sin_angle = np.linalg.norm(skew, axis=-1) / 2
+    cos_angle = (np.trace(rotations, axis1=1, axis2=2) - 1) / 2
+    angles = np.arctan2(sin_angle, cos_angle)
+    axes = np.zeros_like(skew)
+    axes[:,2] = 1.0 # Arbitrary for zero rotation
+    nonzero = sin_angle > 0
+    axes[nonzero] = skew[nonzero] / (2 * sin_angle[nonzero,np.newaxis])
+    return axes, angles
+
+
+def j2000_to_uvw_matrices(directions):
+    """Return the matrices (N * 3 * 3) that rotate J2000 xyz coordinates to uvw coordinates
+    for phase centres given as J2000 unit vectors (N * 3)"""
+    ra = np.arctan2(directions[:,1], directions[:,0])
+    dec = np.arcsin(np.clip(directions[:,2], -1.0, 1.0))
+    sin_ra, cos_ra, sin_dec, cos_dec = np.sin(ra), np.cos(ra), np.sin(dec), np.cos(dec)
+    matrices = np.empty(shape=(len(directions),3,3))
+    matrices[:,0] = np.stack([-sin_ra, cos_ra, np.zeros_like(ra)], axis=-1)
+    matrices[:,1] = np.stack([-sin_dec * cos_ra, -sin_dec * sin_ra, cos_dec], axis=-1)
+    matrices[:,2] = np.stack([cos_dec * cos_ra, cos_dec * sin_ra, sin_dec], axis=-1)
+    return matrices
+
+
+def lagrange_weights(x, n_points):
+    """Return interpolation weights (N * n_points) for positions x (N) on the unit spaced
+    grid 0..n_points-1"""
+    x = np.asarray(x, dtype=np.float64)
+    weights = np.ones(shape=(len(x), n_points))
+    for k in range(n_points):
+        for j in range(n_points):
+            if j != k:
+                weights[:,k] *= (x - j) / (k - j)
+    return weights
+
+
+def _unit_vector(lon, lat):
+    return np.array([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
 class UVW(object):
     _measures = measures()
 
@@ -78,9 +142,8 @@ class UVW(object):
         self._properties_set[value["type"]] = value
         self._up_to_date = False
     
-    def _update(self):
-        """Check that the necessary frame information is set and then calculate J2000 baselines."""
-        required_attributes = ["epoch", "direction"]
+    def _do_frame(self, required_attributes=["epoch", "direction"]):
+        """Check that the necessary frame information is set and apply it to the measures server."""
         for attribute in required_attributes:
             if attribute not in self._properties_set:
                 raise ValueError("Attributes: {} must be all set".format(required_attributes))
@@ -90,7 +153,12 @@ class UVW(object):
         self._measures.do_frame(self._properties_set["epoch"])
         self._measures.do_frame(self._properties_set["direction"])
         self._measures.do_frame(self._properties_set["position"])
-        self._uvw0 = np.array(self._measures.to_uvw(self._itrf_baselines)["xyz"].get_value("m")).reshape((-1,3)) # to_uvw converts to J2000
+
+    def _update(self):
+        """Check that the necessary frame information is set and then calculate J2000 baselines."""
+        with span("to_uvw"):
+            self._do_frame()
+            self._uvw0 = np.array(self._measures.to_uvw(self._itrf_baselines)["xyz"].get_value("m")).reshape((-1,3)) # to_uvw converts to J2000
         self._up_to_date = True
 
     @property
@@ -108,6 +176,130 @@ class UVW(object):
         """Returns the full matrix of UVWs"""
         return self.uvw0.reshape((-1,1,3)) - self.uvw0.reshape((1,-1,3))
     
+    def _reference_frame(self, time):
+        """Return the ITRF to J2000 rotation matrix and the J2000 unit vector of the direction
+        at time (UTC MJD seconds), both calculated with casacore"""
+        self.set_time(float(time))
+        self._do_frame()
+        unit = quantity([1.0, 0.0, 0.0], "m"), quantity([0.0, 1.0, 0.0], "m"), quantity([0.0, 0.0, 1.0], "m")
+        j2000 = self._measures.measure(self._measures.baseline("itrf", *unit), "J2000")
+        rotation = _unit_vector(j2000["m0"]["value"], j2000["m1"]["value"])
+        direction = self._measures.measure(self._properties_set["direction"], "J2000")
+        return rotation, _unit_vector(direction["m0"]["value"], direction["m1"]["value"])
+
+    def uvw0_batch(self, times, reference_interval=DEFAULT_REFERENCE_INTERVAL):
+        """Return reference UVWs (N_time * N_ant * 3) for an array of UTC times in MJD seconds.
+        casacore is only used at reference epochs spaced at most reference_interval apart,
+        in between the ITRF to J2000 rotation is interpolated as a rotation about the Earth's
+        axis and the direction is interpolated in J2000, or in ITRF for directions fixed to
+        the Earth (AZEL, HADEC, etc.). Compared to setting each time and reading uvw0,
+        baseline UVWs agree to within 2e-8 of the baseline length (2 um for 100 m) with the
+        default one hour reference interval. The reference UVWs themselves are relative to
+        the Earth's centre and can differ by up to ~2 cm, but that error is common to all
+        antennas and cancels in baselines and geometric phases."""
+        with span("uvw0_batch") as s:
+            uvw0 = self._uvw0_batch(np.asarray(times, dtype=np.float64).reshape(-1), reference_interval)
+            s.nbytes = uvw0.nbytes
+        return uvw0
+
+    def _uvw0_batch(self, times, reference_interval):
+        saved_epoch = self._properties_set.get("epoch")
+        n_ref = max(int(np.ceil((times.max() - times.min()) / reference_interval)), 1) + 1
+        ref_times = np.linspace(times.min(), times.max(), n_ref)
+        if ref_times[0] == ref_times[-1]:
+            ref_times = ref_times[:1]
+        with span("reference_frames"):
+            frames = [self._reference_frame(t) for t in ref_times]
+        ref_rotations = np.array([f[0] for f in frames])
+        ref_directions = np.array([f[1] for f in frames])
+        if saved_epoch is not None:
+            self.set_measure(saved_epoch)
+        self._up_to_date = False
+
+        if len(ref_times) == 1:
+            rotations = ref_rotations.repeat(len(times), axis=0)
+            directions = ref_directions.repeat(len(times), axis=0)
+        else:
+            i = np.clip(np.searchsorted(ref_times, times, side="right") - 1, 0, len(ref_times) - 2)
+            frac = ((times - ref_times[i]) / (ref_times[i+1] - ref_times[i]))[:,np.newaxis]
+            # Rotation in the ITRF frame from one reference epoch to the next
+            steps = np.einsum("kji,kjl->kil", ref_rotations[:-1], ref_rotations[1:])
+            axes, angles = rotation_axis_angle(steps)
+            rotations = np.einsum("tij,tjk->tik", ref_rotations[i], rotation_matrices(axes[i], angles[i] * frac[:,0]))
+            if self._properties_set["direction"]["refer"].upper() in EARTH_FIXED_DIRECTIONS:
+                itrf_directions = np.einsum("kji,kj->ki", ref_rotations, ref_directions)
+                directions = (1 - frac) * itrf_directions[i] + frac * itrf_directions[i+1]
+                directions = np.einsum("tij,tj->ti", rotations, directions)
+            else:
+                directions = (1 - frac) * ref_directions[i] + frac * ref_directions[i+1]
+            directions /= np.linalg.norm(directions, axis=-1)[:,np.newaxis]
+        to_uvw = np.einsum("tij,tjk->tik", j2000_to_uvw_matrices(directions), rotations)
+        return np.einsum("tij,aj->tai", to_uvw, self.antenna_positions)
+
+    def _exact_uvw0(self, times):
+        saved_epoch = self._properties_set.get("epoch")
+        uvw0 = np.empty(shape=(len(times),self.n_ant,3), dtype=np.float64)
+        for i, t in enumerate(times):
+            self.set_time(float(t))
+            uvw0[i] = self.uvw0
+        if saved_epoch is not None:
+            self.set_measure(saved_epoch)
+        return uvw0
+
+    @staticmethod
+    def _interpolate(knot_times, knot_uvw0, times):
+        """Piecewise polynomial interpolation of knot_uvw0 on the evenly spaced knot_times"""
+        n_points = min(INTERPOLATION_ORDER + 1, len(knot_times))
+        if n_points == 1:
+            return knot_uvw0[[0] * len(times)]
+        step = knot_times[1] - knot_times[0]
+        pos = (times - knot_times[0]) / step
+        first = np.clip(np.floor(pos).astype(int) - (n_points - 1) // 2, 0, len(knot_times) - n_points)
+        weights = lagrange_weights(pos - first, n_points)
+        stencil = first[:,np.newaxis] + np.arange(n_points)
+        return np.einsum("tk,tkaj->taj", weights, knot_uvw0[stencil])
+
+    def uvw0_interpolated(self, times, knot_interval=DEFAULT_KNOT_INTERVAL, check=True):
+        """Return reference UVWs (N_time * N_ant * 3) for an array of UTC times in MJD seconds
+        and an error report. Exact UVWs are calculated at knots spaced knot_interval apart and
+        interpolated in between with a cubic polynomial through the four nearest knots.
+        The polynomial error for a station at radius R from the Earth's centre is only
+        ~R * (omega * knot_interval)**4 / 40 with omega the Earth rotation rate, ~6e-5 m for
+        60 s knots, but the exact reference UVWs are not that smooth: casacore steps its
+        own frame conversion, so reference UVWs differ from exact ones by up to ~1e-2 m
+        whatever the knot spacing (8e-3 m measured for J2000 over 3 h). The steps are
+        common to all antennas, so the baseline UVWs, the differences between reference
+        UVWs, agree to ~1e-6 m for a station.
+        With check set, exact UVWs are also calculated halfway between knots and the
+        largest reference error component (max_error) and the largest baseline error
+        (max_baseline_error) found are included in the report."""
+        with span("uvw0_interpolated") as s:
+            uvw0, report = self._uvw0_interpolated(np.asarray(times, dtype=np.float64).reshape(-1), knot_interval, check)
+            s.nbytes = uvw0.nbytes
+        return uvw0, report
+
+    def _uvw0_interpolated(self, times, knot_interval, check):
+        n_knot = max(int(np.ceil((times.max() - times.min()) / knot_interval)) + 1, INTERPOLATION_ORDER + 1)
+        report = {"knot_interval": knot_interval, "n_knot": n_knot, "n_check": 0,
+                  "max_error": 0.0, "max_baseline_error": 0.0}
+        if len(times) <= n_knot:
+            # Not worth interpolating
+            report["n_knot"] = len(times)
+            self._up_to_date = False
+            return self._exact_uvw0(times), report
+        knot_times = times.min() + knot_interval * np.arange(n_knot)
+        knot_uvw0 = self._exact_uvw0(knot_times)
+        uvw0 = self._interpolate(knot_times, knot_uvw0, times)
+        if check:
+            check_times = knot_times[:-1] + knot_interval / 2
+            error = self._interpolate(knot_times, knot_uvw0, check_times) - self._exact_uvw0(check_times)
+            report["n_check"] = len(check_times)
+            report["max_error"] = float(np.abs(error).max())
+            # The largest difference between antennas bounds the error of every baseline
+            report["max_baseline_error"] = float(np.linalg.norm(error.max(axis=1) - error.min(axis=1), axis=-1).max())
+        self._up_to_date = False
+        return uvw0, report
+
     def packed(self):
         """Returns an array of lenght N_baselines of UVWs for the upper triangular correlation matrix"""
-        return self()[np.triu_indices(self.n_ant)]
+        return packing_plan(self.n_ant, 1, 1).uvw(self.uvw0[np.newaxis])[0]
@@ -24,7 +24,8 @@ setup(
         'Topic :: Utilities',
         ],
     install_requires=['numpy', 'python-casacore'],
-    packages=find_packages(exclude=['tests','examples']),
+    extras_require={'hdf5': ['h5py']},
+    packages=find_packages(exclude=['tests','examples','benchmarks']),
     package_data={'lofarstation': ['AntennaFields/*']},
     entry_points={
         'console_scripts': [
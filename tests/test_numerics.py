@@ -0,0 +1,327 @@
+"""Checks of the fast numerical paths against the exact calculations they replace,
+within the tolerances given in their documentation."""
+
+from __future__ import absolute_import
+from __future__ import division
+from benchmarks import synthetic
+from lofarstation.stationdata import XSTData, AARTFAACData, write_concat_ms
+from lofarstation.packing import PackingPlan
+from lofarstation.meas_set.storage_layouts import storage_layouts
+from lofarstation import imaging
+from lofarstation.follow import follow, MSSink
+from lofarstation.datetime_casacore import datetime_casacore
+from casacore.measures import measures
+from casacore.tables import table
+import datetime
+import numpy as np
+import os
+import shutil
+import tempfile
+import unittest
+import weakref
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+STATION_NAME = "SE607"
+
+
+def _baseline_spread(error):
+    """Largest difference between the errors of two antennas (N_time * N_ant * 3)"""
+    return np.linalg.norm(error.max(axis=1) - error.min(axis=1), axis=-1).max()
+
+
+class UVWTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.station_data = XSTData(synthetic.write_xst(cls.directory, 2), 3, 300, 1.0, station_name=STATION_NAME)
+        positions = cls.station_data.antenna_positions
+        cls.max_baseline = np.linalg.norm(positions[:,np.newaxis] - positions[np.newaxis], axis=-1).max()
+        cls.times = cls.station_data.time_mjd[0] + np.arange(0.0, 3 * 3600.0, 37.0)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def machine(self, direction):
+        uvw_machine = self.station_data._uvw_machine()
+        uvw_machine.set_direction(direction)
+        return uvw_machine
+
+    def directions(self):
+        return [measures().direction("J2000", "1.0rad", "0.7rad"), measures().direction("AZELGEO", "0deg", "90deg")]
+
+    def test_batch(self):
+        for direction in self.directions():
+            uvw_machine = self.machine(direction)
+            exact = uvw_machine._exact_uvw0(self.times)
+            error = uvw_machine.uvw0_batch(self.times) - exact
+            self.assertLess(np.abs(error).max(), 2e-2)
+            self.assertLess(_baseline_spread(error), 2e-8 * self.max_baseline)
+
+    def test_interpolated(self):
+        for direction in self.directions():
+            uvw_machine = self.machine(direction)
+            exact = uvw_machine._exact_uvw0(self.times)
+            uvw0, report = uvw_machine.uvw0_interpolated(self.times)
+            error = uvw0 - exact
+            self.assertLess(np.abs(error).max(), 1e-2)
+            self.assertLess(_baseline_spread(error), 1e-6)
+            self.assertGreater(report["n_check"], 0)
+            self.assertLess(report["max_error"], 1e-2)
+            self.assertLess(report["max_baseline_error"], 1e-6)
+
+
+class PackingTest(unittest.TestCase):
+    def test_round_trip(self):
+        rng = np.random.RandomState(0)
+        for n_ant, n_pol, n_channel in [(5, 2, 1), (4, 2, 3), (6, 1, 2)]:
+            plan = PackingPlan(n_ant, n_pol, n_channel)
+            n_inputs = n_ant * n_pol
+            m = rng.standard_normal((3, n_inputs, n_inputs, n_channel, 2)).view(np.complex128)[...,0]
+            full = m + m.conj().swapaxes(1, 2)
+            packed = plan.pack(full)
+            self.assertEqual(packed.shape, (3,) + plan.packed_shape)
+            np.testing.assert_array_equal(plan.expand(packed), full)
+            out = np.empty((3 * plan.n_baseline, n_channel, n_pol * n_pol), dtype=np.complex128)
+            plan.pack(full, out)
+            np.testing.assert_array_equal(out.reshape(packed.shape), packed)
+
+
+class PackedStorageTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        xst = synthetic.write_xst(cls.directory, 4)
+        cls.full = XSTData(xst, 3, 300, 1.0, station_name=STATION_NAME)
+        cls.packed = XSTData(xst, 3, 300, 1.0, station_name=STATION_NAME)
+        cls.packed.packed_storage = True
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def test_data_indexing(self):
+        full = self.full.data
+        packed = self.packed.data
+        keys = [1, -1, slice(1, 3), (2, 5), (slice(None), 3, slice(2, 9)), Ellipsis, (Ellipsis, 0),
+                (1, Ellipsis), (1, Ellipsis, 0), (slice(None), Ellipsis), [3, 0, 3], np.array([True, False, True, False]),
+                ([0, 2], [4, 6]), ([[0], [3]], [1, 2], 0), (np.array([1, 1]), Ellipsis, 0)]
+        for key in keys:
+            # Calibrated in a different order, so equal to rounding
+            np.testing.assert_allclose(packed[key], full[key], rtol=0, atol=1e-12, err_msg=repr(key))
+        np.testing.assert_allclose(np.asarray(packed), full, rtol=0, atol=1e-12)
+        for key in [np.newaxis, (0, np.newaxis), (Ellipsis, 0, Ellipsis), (0, 0, 0, 0, 0)]:
+            self.assertRaises(IndexError, packed.__getitem__, key)
+
+
+class ImagingTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.station_data = XSTData(synthetic.write_xst(cls.directory, 3), 3, 300, 1.0, station_name=STATION_NAME)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def test_fft_images(self):
+        for polarisation, exclude_autos in [("I", True), ("XX", False)]:
+            dft = imaging.images(self.station_data, 64, polarisation, exclude_autos)
+            fft = imaging.fft_images(self.station_data, 64, polarisation, exclude_autos)
+            np.testing.assert_array_equal(np.isnan(fft), np.isnan(dft))
+            self.assertLess(np.nanmax(np.abs(fft - dft)), 1e-3 * np.nanmax(np.abs(dft)))
+
+
+class StorageLayoutTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.station_data = XSTData(synthetic.write_xst(cls.directory, 3), 3, 300, 1.0, station_name=STATION_NAME)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def write(self, layout):
+        ms_name = os.path.join(self.directory, layout + ".ms")
+        self.station_data.write_ms(ms_name, chunk_size=2, layout=layout)
+        return table(ms_name, ack=False)
+
+    def test_layouts(self):
+        default = self.write("default")
+        columns = [c for c in default.colnames() if default.iscelldefined(c, 0)]
+        for layout in sorted(storage_layouts):
+            if layout == "default":
+                continue
+            ms = self.write(layout)
+            self.assertEqual(ms.nrows(), default.nrows())
+            for column in columns:
+                np.testing.assert_array_equal(ms.getcol(column), default.getcol(column), err_msg="{} {}".format(layout, column))
+            ms.close()
+        default.close()
+
+class ConcatTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        # Captures of 2 blocks, a gap of 3 seconds between the first two, the last overlaps
+        cls.inputs = []
+        for i, name in enumerate(["20170101_120000_xst.dat", "20170101_120005_xst.dat", "20170101_120006_xst.dat"]):
+            cls.inputs.append(os.path.join(cls.directory, name))
+            os.rename(synthetic.write_xst(tempfile.mkdtemp(dir=cls.directory), 2, seed=i), cls.inputs[-1])
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def load(self, datafile):
+        self.assertEqual(len(self.opened), 0, "An input is still open")
+        station_data = XSTData(datafile, 3, 300, 1.0, station_name=STATION_NAME)
+        self.opened.add(station_data)
+        return station_data
+
+    def test_concat(self):
+        self.opened = weakref.WeakSet()
+        ms_name = os.path.join(self.directory, "concat.ms")
+        write_concat_ms(self.inputs[1::-1], ms_name, chunk_size=1, load=self.load)
+        ms = table(ms_name, ack=False)
+        expected = [XSTData(datafile, 3, 300, 1.0, station_name=STATION_NAME) for datafile in self.inputs[:2]]
+        np.testing.assert_array_equal(np.unique(ms.getcol("TIME")), np.concatenate([sd.time_mjd for sd in expected]))
+        data = np.concatenate([sd.packed_data() for sd in expected])
+        np.testing.assert_allclose(ms.getcol("DATA"), data.astype(np.complex64), rtol=1e-6)
+        observation = table(ms.getkeyword("OBSERVATION"), ack=False)
+        np.testing.assert_array_equal(observation.getcell("TIME_RANGE", 0), [expected[0].time_mjd[0], expected[1].time_mjd[-1]])
+        observation.close()
+        ms.close()
+
+    def test_overlap(self):
+        self.opened = weakref.WeakSet()
+        ms_name = os.path.join(self.directory, "overlap.ms")
+        with self.assertRaises(ValueError):
+            write_concat_ms(self.inputs, ms_name, load=self.load)
+        self.assertFalse(os.path.exists(ms_name))
+
+
+class _GrowingSink(MSSink):
+    """MSSink that writes the rest of the capture after the first append, as if it were still being written"""
+    def __init__(self, ms_name, capture, rest):
+        super(_GrowingSink, self).__init__(ms_name, chunk_size=2)
+        self.capture = capture
+        self.rest = rest
+
+    def append(self, station_data):
+        super(_GrowingSink, self).append(station_data)
+        if self.rest:
+            with open(self.capture, "ab") as f:
+                f.write(self.rest)
+            self.rest = b""
+
+
+class FollowTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.datafile = synthetic.write_xst(cls.directory, 5)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def test_follow(self):
+        station_data = XSTData(self.datafile, 3, 300, 1.0, station_name=STATION_NAME)
+        ms_name = os.path.join(self.directory, "whole.ms")
+        station_data.write_ms(ms_name, chunk_size=2)
+
+        # Start with 2 complete blocks and part of the third
+        with open(self.datafile, "rb") as f:
+            contents = f.read()
+        split = station_data.block_bytes * 5 // 2
+        capture = os.path.join(self.directory, os.path.basename(self.datafile).replace(".dat", "_capture.dat"))
+        with open(capture, "wb") as f:
+            f.write(contents[:split])
+        load = lambda first_block, n_blocks: XSTData(capture, 3, 300, 1.0, station_name=STATION_NAME,
+                                                     first_block=first_block, n_blocks=n_blocks)
+        followed_name = os.path.join(self.directory, "followed.ms")
+        n_block = follow(capture, load, _GrowingSink(followed_name, capture, contents[split:]),
+                         max_blocks=2, idle_timeout=0, poll_interval=0)
+        self.assertEqual(n_block, 5)
+
+        whole, followed = table(ms_name, ack=False), table(followed_name, ack=False)
+        for column in ["TIME", "ANTENNA1", "ANTENNA2", "UVW", "DATA", "FLAG"]:
+            np.testing.assert_array_equal(followed.getcol(column), whole.getcol(column), err_msg=column)
+        observations = [table(ms.getkeyword("OBSERVATION"), ack=False) for ms in (whole, followed)]
+        np.testing.assert_array_equal(observations[1].getcell("TIME_RANGE", 0), observations[0].getcell("TIME_RANGE", 0))
+        for tab in observations + [whole, followed]:
+            tab.close()
+
+
+@unittest.skipIf(h5py is None, "h5py is not installed")
+class HDF5Test(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.station_data = XSTData(synthetic.write_xst(cls.directory, 3), 3, 300, 1.0, station_name=STATION_NAME)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def test_write_hdf5(self):
+        filename = os.path.join(self.directory, "test.h5")
+        self.station_data.write_hdf5(filename, chunk_size=2)
+        station_data = self.station_data
+        packed = station_data.packed_data()
+        data = packed.reshape((station_data.n_block, station_data.n_baseline) + packed.shape[1:])
+        with h5py.File(filename, "r") as f:
+            np.testing.assert_allclose(f["data"][:], data.astype(np.complex64), rtol=1e-6)
+            np.testing.assert_array_equal(f["uvw0"][:], station_data.uvw0)
+            np.testing.assert_array_equal(f["uvw"][:].reshape((-1, 3)), station_data.packed_uvw())
+            np.testing.assert_array_equal(f["time"][:], station_data.time_mjd)
+            np.testing.assert_array_equal(f["antenna1"][:], station_data.packing_plan.ant1)
+            np.testing.assert_array_equal(f["antenna2"][:], station_data.packing_plan.ant2)
+            np.testing.assert_array_equal(f["frequency"][:], station_data.frequency)
+            self.assertEqual(f.attrs["station_name"], STATION_NAME)
+
+
+class _FillData(AARTFAACData):
+    """AARTFAACData with only what filling the correlation matrices needs"""
+    n_ant = 5
+
+    def __init__(self):
+        self.trilind = np.tril_indices(self.n_ant)
+
+
+class AARTFAACTest(unittest.TestCase):
+    def test_fill_hermitian(self):
+        station_data = _FillData()
+        row, col = station_data.trilind
+        rng = np.random.RandomState(1)
+        vis = (rng.randn(3, len(row), 2) + 1j * rng.randn(3, len(row), 2)).astype(np.complex64)
+        out = np.zeros((3, station_data.n_ant, 2, station_data.n_ant, 2), dtype=np.complex64)
+        station_data._fill_hermitian(vis, out)
+        for pol in range(2):
+            expected = np.zeros((3, station_data.n_ant, station_data.n_ant), dtype=np.complex64)
+            expected[:, col, row] = vis[..., pol]
+            expected[:, row, col] = vis[..., pol].conj()
+            np.testing.assert_array_equal(out[:, :, pol, :, pol], expected)
+        self.assertFalse(out[:, :, 0, :, 1].any() or out[:, :, 1, :, 0].any())
+
+    def test_record_slots(self):
+        class Datafile(object):
+            fname = "test.vis"
+            dt = datetime.timedelta(seconds=2)
+            tfilestart = datetime.datetime(2017, 1, 1, 12)
+            missrec = [1, 4] # Record indices from the start of the file
+        # The first record read is record 2 of the file, with gaps at slots 1, 4 and 5
+        file_start = datetime_casacore.from_datetime(Datafile.tfilestart).mjd_seconds()
+        time_mjd = file_start + 4.0 + np.array([0.0, 4.0, 6.1, 12.0])
+        slot, grid_mjd, missing = AARTFAACData._record_slots(Datafile(), time_mjd)
+        np.testing.assert_array_equal(slot, [0, 2, 3, 6])
+        np.testing.assert_array_equal(grid_mjd[slot], time_mjd)
+        np.testing.assert_array_equal(np.flatnonzero(missing), [1, 2, 4, 5])
+
+if __name__ == "__main__":
+    unittest.main()